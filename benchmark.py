@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+# Benchmarks for podloader. These don't touch your config, DB, keyring or server; everything
+# (FLACs, cover art, a GPG home, an SQLite DB) is generated in a throwaway temp dir.
+# Results can be written out as JSON (-o/--output) to compare between commits.
+
+import argparse
+import os
+import sys
+import time
+import json
+import shutil
+import hashlib
+import platform
+import tempfile
+import datetime
+import subprocess
+import podloader
+
+def mkRandFile(path, size):
+    with open(path, 'wb') as f:
+        left = size
+        while left > 0:
+            chunk = min(left, 1048576)
+            f.write(os.urandom(chunk))
+            left -= chunk
+    return(path)
+
+def oldSHA256(mediafile):
+    # The original 4 KiB loop from getSHA256(), kept here as the baseline.
+    filehash = hashlib.sha256()
+    with open(mediafile, 'rb') as f:
+        for chunk in iter(lambda: f.read(4096), b''):
+            filehash.update(chunk)
+    return(filehash.hexdigest(), os.path.getsize(mediafile))
+
+def timeIt(func, *args, rounds = 3):
+    # Best of N, which is the least noisy for something this I/O-bound.
+    best = None
+    for i in range(rounds):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return(best, result)
+
+def benchHash(args):
+    size = args.size * 1048576
+    tmpdir = tempfile.mkdtemp(prefix = 'podloader.bench.')
+    try:
+        files = {'mp3': mkRandFile(os.path.join(tmpdir, 'bench.mp3'), size),
+                 'ogg': mkRandFile(os.path.join(tmpdir, 'bench.ogg'), size)}
+        results = {}
+        results['4KiB loop (1 file)'], old = timeIt(oldSHA256, files['mp3'], rounds = args.rounds)
+        results['getHash (1 file)'], new = timeIt(podloader.getHash, files['mp3'], rounds = args.rounds)
+        if old != new:
+            exit('ERROR: getHash() does not agree with the 4 KiB loop!')
+        results['4KiB loop (2 files, serial)'], _ = timeIt(lambda: [oldSHA256(f) for f in files.values()],
+                                                           rounds = args.rounds)
+        results['hashAll (2 files, threaded)'], _ = timeIt(podloader.hashAll, files, rounds = args.rounds)
+    finally:
+        shutil.rmtree(tmpdir)
+    print('{0}: SHA256 + size of {1} MiB file(s), best of {2}:'.format(datetime.datetime.now(),
+                                                                     args.size,
+                                                                     args.rounds))
+    for name, elapsed in results.items():
+        files = 2 if '2 files' in name else 1
+        print('\t{0:30}: {1:8.3f}s ({2:8.1f} MiB/s)'.format(name, elapsed, (args.size * files) / elapsed))
+    return(results)
+
+def genFLAC(path, seconds):
+    # Pink noise rather than silence/a sine, so the encoders have something realistic to chew on.
+    subprocess.run(['ffmpeg', '-nostats', '-loglevel', '0', '-y', '-f', 'lavfi',
+                    '-i', 'anoisesrc=d={0}:c=pink:a=0.2:r=44100'.format(seconds),
+                    '-ac', '2', '-sample_fmt', 's16', path], check = True)
+    return(path)
+
+def genImages(tmpdir):
+    # {name: path} for progressive/baseline JPEGs, large and small.
+    from PIL import Image
+    imgs = {}
+    for size, px in (('large', 3000), ('small', 600)):
+        img = Image.effect_noise((px, px), 64).convert('RGB')
+        for mode in ('progressive', 'baseline'):
+            imgs['{0}-{1}'.format(mode, size)] = os.path.join(tmpdir, '{0}-{1}.jpg'.format(mode, size))
+            img.save(imgs['{0}-{1}'.format(mode, size)], format = 'JPEG', quality = 90,
+                     progressive = (mode == 'progressive'))
+    return(imgs)
+
+def genGPGHome(tmpdir):
+    # Returns (homedir, fingerprint) of a new passphrase-less signing key, or (None, None) without gpg.
+    home = os.path.join(tmpdir, 'gnupg')
+    os.makedirs(home, mode = 0o700)
+    try:
+        subprocess.run(['gpg', '--homedir', home, '--batch', '--passphrase', '',
+                        '--quick-gen-key', 'Podloader Benchmark <bench@localhost>',
+                        'default', 'sign', 'never'], check = True,
+                       stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        out = subprocess.run(['gpg', '--homedir', home, '--batch', '--with-colons', '--list-secret-keys'],
+                             check = True, stdout = subprocess.PIPE).stdout.decode('utf-8')
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return(None, None)
+    fpr = [l.split(':')[9] for l in out.splitlines() if l.startswith('fpr:')][0]
+    return(home, fpr)
+
+def benchConf(tmpdir, gpghome, fpr):
+    # A config (on top of podloader.ini.dist) that keeps everything in tmpdir.
+    inifile = os.path.join(tmpdir, 'podloader.ini')
+    with open(inifile, 'w') as f:
+        f.write('\n'.join(['[mysql]',
+                           'sqlite = {0}/bench.db'.format(tmpdir),
+                           '[gpg]',
+                           'enabled = {0}'.format(bool(gpghome)),
+                           'keys = {0}'.format(fpr or ''),
+                           'homedir = {0}'.format(gpghome or tmpdir),
+                           '[local]',
+                           'path = {0}/podcast'.format(tmpdir),
+                           '[tags]',
+                           'img = {0}/progressive-large.jpg'.format(tmpdir),
+                           '[cache]',
+                           'path = {0}/cache'.format(tmpdir),
+                           'transcode_size = 0',
+                           '[log]',
+                           'runlog = False',
+                           'summary = False',
+                           '']))
+    return(inifile)
+
+def benchArgs(episode, flac, raw):
+    # What argParse() would return for a made-up episode.
+    return(['-t', 'Benchmark Episode {0}'.format(episode),
+            '-s', '1',
+            '-e', str(episode),
+            '-r', raw,
+            '-f', flac,
+            '-i:a', 'Intro Artist', '-i:t', 'Intro', '-i:l', 'https://intro.tld', '-i:c', 'CC-BY-SA 3.0',
+            '-o:a', 'Outro Artist', '-o:t', 'Outro', '-o:l', 'https://outro.tld', '-o:c', 'CC-BY-SA 3.0',
+            '-F'])
+
+def benchPipeline(args):
+    results = {}
+    tmpdir = tempfile.mkdtemp(prefix = 'podloader.bench.')
+    # configParse() caches the parsed config under $XDG_CACHE_HOME; keep that out of the real ~/.cache too.
+    xdg_cache = os.environ.get('XDG_CACHE_HOME')
+    os.environ['XDG_CACHE_HOME'] = os.path.join(tmpdir, 'xdg')
+    try:
+        print('{0}: Generating fixtures in {1}...'.format(datetime.datetime.now(), tmpdir))
+        imgs = genImages(tmpdir)
+        gpghome, fpr = genGPGHome(tmpdir)
+        if not gpghome:
+            print('{0}: gpg is not available; skipping the signing benchmarks.'.format(datetime.datetime.now()))
+        inifile = benchConf(tmpdir, gpghome, fpr)
+        raw = genFLAC(os.path.join(tmpdir, 'raw.flac'), 1)
+        # Warm up PIL's plugins first, or whichever image goes first pays for loading them.
+        podloader.imgConv(imgs['baseline-small'])
+        results['imgConv'] = {}
+        for name, imgfile in imgs.items():
+            results['imgConv'][name], _ = timeIt(podloader.imgConv, imgfile, rounds = args.rounds)
+        # Stub out everything that would leave the machine.
+        podloader.stage_funcs['db'] = lambda conf: ((), None)
+        podloader.stage_funcs['upload'] = lambda conf: ((), None)
+        configParse = podloader.configParse
+        podloader.configParse = lambda *a, **k: configParse(inifile)
+        for episode, seconds in enumerate(args.lengths, start = 1):
+            name = '{0}s'.format(seconds)
+            print('{0}: Benchmarking a {1} second episode...'.format(datetime.datetime.now(), seconds))
+            flac = genFLAC(os.path.join(tmpdir, 'bench{0}.flac'.format(episode)), seconds)
+            sys.argv = ['podloader'] + benchArgs(episode, flac, raw)
+            conf = podloader.confArgs(configParse(inifile), podloader.argParse())
+            res = {}
+            res['transcode'], media = timeIt(podloader.transcodeAll, conf, rounds = 1)
+            conf['episode']['media'] = media
+            res['tag'], _ = timeIt(podloader.stageTag, conf, rounds = 1)
+            res['hash'], _ = timeIt(podloader.stageHash, conf, rounds = args.rounds)
+            res['getSHA256'], _ = timeIt(lambda: [podloader.getSHA256(f) for f in media.values()],
+                                         rounds = args.rounds)
+            if gpghome:
+                # Each round needs fresh sigs, or signEp() would just see they're already there.
+                def sign():
+                    for f in podloader.signAll(conf).values():
+                        os.remove(f)
+                res['sign'], _ = timeIt(sign, rounds = args.rounds)
+            res['main'], _ = timeIt(podloader.main, rounds = 1)
+            results[name] = res
+    finally:
+        if xdg_cache is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = xdg_cache
+        shutil.rmtree(tmpdir)
+    print('{0}: Pipeline stages (best of {1} where repeated):'.format(datetime.datetime.now(), args.rounds))
+    for name, elapsed in results['imgConv'].items():
+        print('\t{0:30}: {1:8.3f}s'.format('imgConv ' + name, elapsed))
+    for length in args.lengths:
+        for stage, elapsed in results['{0}s'.format(length)].items():
+            print('\t{0:30}: {1:8.3f}s'.format('{0}s {1}'.format(length, stage), elapsed))
+    return(results)
+
+# The modules podloader.py/verifyfeed.py should only load once a stage needs them; see benchImport().
+heavy_modules = ('pymysql', 'gpgme', 'mutagen', 'PIL', 'paramiko', 'lxml', 'magic')
+
+def benchImport(args):
+    # Each in a fresh interpreter, since that's what a user (or a script validating a batch) pays.
+    here = os.path.dirname(os.path.realpath(__file__))
+    cmds = {'python -c pass (baseline)': [sys.executable, '-c', 'pass'],
+            'import podloader': [sys.executable, '-c', 'import podloader'],
+            'import verifyfeed': [sys.executable, '-c', 'import verifyfeed'],
+            'podloader.py --help': [sys.executable, os.path.join(here, 'podloader.py'), '--help'],
+            'verifyfeed.py --help': [sys.executable, os.path.join(here, 'verifyfeed.py'), '--help']}
+    results = {}
+    for name, cmd in cmds.items():
+        results[name], _ = timeIt(lambda: subprocess.run(cmd, cwd = here, check = True,
+                                                         stdout = subprocess.DEVNULL),
+                                  rounds = args.rounds)
+    print('{0}: Startup time, best of {1}:'.format(datetime.datetime.now(), args.rounds))
+    for name, elapsed in results.items():
+        print('\t{0:30}: {1:8.1f}ms'.format(name, elapsed * 1000))
+    loaded = subprocess.run([sys.executable, '-c',
+                             'import sys, json, podloader, verifyfeed; print(json.dumps(sorted(m for m in {0!r} if m in sys.modules)))'.format(heavy_modules)],
+                            cwd = here, check = True, stdout = subprocess.PIPE).stdout.decode('utf-8')
+    loaded = json.loads(loaded)
+    if loaded:
+        exit('ERROR: Importing podloader/verifyfeed loaded {0}; these should only be imported where they are used.'.format(', '.join(loaded)))
+    if args.max_startup:
+        baseline = results['python -c pass (baseline)']
+        slow = [n for n, e in results.items() if (e - baseline) * 1000 > args.max_startup]
+        if slow:
+            exit('ERROR: {0} took more than {1}ms longer than starting python.'.format(', '.join(slow),
+                                                                                      args.max_startup))
+    return(results)
+
+def gitRev():
+    try:
+        return(subprocess.run(['git', 'rev-parse', 'HEAD'], check = True, stdout = subprocess.PIPE,
+                              stderr = subprocess.DEVNULL,
+                              cwd = os.path.dirname(os.path.realpath(__file__))).stdout.decode('utf-8').strip())
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return(None)
+
+def parseArgs():
+    args = argparse.ArgumentParser(description = 'Podloader micro-benchmarks',
+                                   epilog = 'https://git.square-r00t.net/Podloader')
+    args.add_argument('-s',
+                      '--size',
+                      dest = 'size',
+                      type = int,
+                      default = 200,
+                      help = 'The size (in MiB) of each test file to hash. The default is 200.')
+    args.add_argument('-r',
+                      '--rounds',
+                      dest = 'rounds',
+                      type = int,
+                      default = 3,
+                      help = 'How many times to run each benchmark (the best time is reported). The default is 3.')
+    args.add_argument('-b',
+                      '--bench',
+                      dest = 'benches',
+                      choices = ['import', 'hash', 'pipeline'],
+                      nargs = '*',
+                      default = ['import', 'hash', 'pipeline'],
+                      help = 'Which benchmark(s) to run. The default is all.')
+    args.add_argument('-L',
+                      '--lengths',
+                      dest = 'lengths',
+                      type = lambda x: [int(i) for i in x.split(',')],
+                      default = [300, 1800, 5400, 10800],
+                      help = 'A comma-separated list of the lengths (in seconds) of the FLACs to generate for the pipeline benchmark. The default is 300,1800,5400,10800 (5 minutes to 3 hours).')
+    args.add_argument('-o',
+                      '--output',
+                      dest = 'output',
+                      metavar = 'path',
+                      default = False,
+                      help = 'If specified, write the results to this file as JSON.')
+    args.add_argument('-m',
+                      '--max-startup',
+                      dest = 'max_startup',
+                      metavar = 'ms',
+                      type = float,
+                      default = 0,
+                      help = ('For the import benchmark: fail if importing (or --help for) podloader.py/verifyfeed.py takes more '
+                              'than this many milliseconds on top of starting python itself. The default (0) is not to check.'))
+    return(args)
+
+def main():
+    args = parseArgs().parse_args()
+    results = {'commit': gitRev(),
+               'date': str(datetime.datetime.now()),
+               'host': platform.node(),
+               'cpus': os.cpu_count(),
+               'python': platform.python_version()}
+    if 'import' in args.benches:
+        results['import'] = benchImport(args)
+    if 'hash' in args.benches:
+        results['hash'] = benchHash(args)
+    if 'pipeline' in args.benches:
+        results['pipeline'] = benchPipeline(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 1)
+        print('{0}: Wrote results to {1}.'.format(datetime.datetime.now(), args.output))
+
+if __name__ == '__main__':
+    main()
@@ -25,10 +25,10 @@ DROP TABLE IF EXISTS `myTBL`;
 CREATE TABLE `myTBL` (
   `episode` varchar(8) NOT NULL,
   `file_prefix` varchar(255) NOT NULL,
-  `sha_mp3` char(64) NOT NULL,
-  `sha_ogg` char(64) NOT NULL,
-  `bytesize_mp3` int(16) NOT NULL,
-  `bytesize_ogg` int(16) NOT NULL,
+  `sha_mp3` char(64) DEFAULT NULL,
+  `sha_ogg` char(64) DEFAULT NULL,
+  `bytesize_mp3` int(16) DEFAULT NULL,
+  `bytesize_ogg` int(16) DEFAULT NULL,
   `length` int(8) NOT NULL,
   `editor` varchar(64) NOT NULL,
   `intro_title` varchar(128) NOT NULL,
@@ -52,6 +52,20 @@ CREATE TABLE `myTBL` (
   UNIQUE KEY `sha_ogg_UNIQUE` (`sha_ogg`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Optional columns for the formats besides mp3/ogg ([formats]enabled in podloader.ini)
+--
+
+-- ALTER TABLE `myTBL` ADD COLUMN `sha_opus` char(64) DEFAULT NULL, ADD COLUMN `bytesize_opus` int(16) DEFAULT NULL, ADD UNIQUE KEY `sha_opus_UNIQUE` (`sha_opus`);
+-- ALTER TABLE `myTBL` ADD COLUMN `sha_m4a` char(64) DEFAULT NULL, ADD COLUMN `bytesize_m4a` int(16) DEFAULT NULL, ADD UNIQUE KEY `sha_m4a_UNIQUE` (`sha_m4a`);
+
+--
+-- The mp3/ogg columns are NULL for episodes released without those formats. For a table made
+-- from an older copy of this file (where they were NOT NULL):
+--
+
+-- ALTER TABLE `myTBL` MODIFY `sha_mp3` char(64) DEFAULT NULL, MODIFY `sha_ogg` char(64) DEFAULT NULL, MODIFY `bytesize_mp3` int(16) DEFAULT NULL, MODIFY `bytesize_ogg` int(16) DEFAULT NULL;
 /*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
 
 /*!40101 SET SQL_MODE=@OLD_SQL_MODE */;
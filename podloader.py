@@ -9,40 +9,206 @@ import base64
 import subprocess
 import hashlib
 import datetime
+import time
+import shutil
+import copy
+import csv
+import json
+import struct
+import email.utils
+import sqlite3
+import threading
+import platform
+import resource
+import fcntl
+import contextlib
+import importlib.util
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 # You might need to install these modules; they aren't in stdlib.
-import pymysql
-import magic
-import gpgme
-from mutagen.id3 import ID3, APIC, TALB, TDRC, TENC, TRCK, COMM, WXXX, TCON, TIT2, TPE1, TCOP
-from mutagen.oggvorbis import OggVorbis
-from mutagen.flac import Picture
-from PIL import Image  # This is really pillowtalk for what I'm using. I don't think PIL proper ever released a py3k version.
+# pymysql, gpgme, mutagen and PIL (pillow) are imported in the functions that use them, so
+# --help, --check and disabled features (e.g. [gpg]enabled = False) don't pay to load them.
 # Note: also requires ffmpeg to be installed.
 
+# Instrumentation records for this run (see instrument()), and the ones still in progress.
+# main() puts the run ID in the environment, so worker processes that re-import this module
+# (the spawn/forkserver start methods) tag their records with the same one.
+run_id = (os.environ.get('PODLOADER_RUN_ID') or
+          '{0}.{1}'.format(datetime.datetime.now().strftime('%Y%m%dT%H%M%S'), os.getpid()))
+run_log = []
+run_open = []
+
+def procIO():
+    # Bytes this process has read/written (through any syscall, so including the page cache).
+    io = {'rchar': 0, 'wchar': 0}
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                k, v = line.split(':')
+                io[k] = int(v)
+    except (FileNotFoundError, ValueError):
+        pass
+    return(io)
+
+def logValues(**values):
+    # Adds values (e.g. measurements) to the record of the innermost stage that's running.
+    if run_open:
+        run_open[-1].update(values)
+
+def logExit(cmd, ret):
+    # Records a subprocess's exit status against the innermost stage that's running.
+    if run_open:
+        run_open[-1]['exit_codes'].append([cmd, ret])
+    return(ret)
+
+@contextlib.contextmanager
+def instrument(conf, stage):
+    # Records wall time, CPU time (ours and our subprocesses'), peak RSS, bytes read/written
+    # and subprocess exit codes for a stage, and appends it to [log]runlog as a JSON line.
+    # Subprocesses' I/O is only visible to us as block I/O, so it's counted in 512-byte blocks.
+    # Note that CPU time and peak RSS are process-wide, so they overlap for stages that run concurrently.
+    rec = {'run': run_id,
+           'episode': conf.get('episode', {}).get('id'),
+           'stage': stage,
+           'start': str(datetime.datetime.now()),
+           'exit_codes': []}
+    wall = time.perf_counter()
+    ru_self = resource.getrusage(resource.RUSAGE_SELF)
+    ru_child = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io = procIO()
+    run_open.append(rec)
+    # The stage can also set this to False itself if it fails without raising.
+    rec['ok'] = True
+    try:
+        yield(rec)
+    except BaseException:
+        rec['ok'] = False
+        raise
+    finally:
+        run_open.remove(rec)
+        ru_self2 = resource.getrusage(resource.RUSAGE_SELF)
+        ru_child2 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io2 = procIO()
+        rec['wall'] = round(time.perf_counter() - wall, 3)
+        rec['cpu'] = round((ru_self2.ru_utime - ru_self.ru_utime) + (ru_self2.ru_stime - ru_self.ru_stime), 3)
+        rec['cpu_children'] = round((ru_child2.ru_utime - ru_child.ru_utime) +
+                                    (ru_child2.ru_stime - ru_child.ru_stime), 3)
+        rec['peak_rss_kb'] = ru_self2.ru_maxrss
+        rec['peak_rss_children_kb'] = ru_child2.ru_maxrss
+        rec['bytes_read'] = (io2['rchar'] - io['rchar']) + 512 * (ru_child2.ru_inblock - ru_child.ru_inblock)
+        rec['bytes_written'] = (io2['wchar'] - io['wchar']) + 512 * (ru_child2.ru_oublock - ru_child.ru_oublock)
+        run_log.append(rec)
+        runlog = conf.get('log', {}).get('runlog')
+        if runlog:
+            os.makedirs(os.path.dirname(runlog), exist_ok = True)
+            with open(runlog, 'a') as f:
+                f.write(json.dumps(rec) + '\n')
+
+def runSummary(conf):
+    # Prints a table of this run's stages. The runlog is preferred since it also has the
+    # records from batch mode's worker processes.
+    records = run_log
+    if conf['log']['runlog'] and os.path.isfile(conf['log']['runlog']):
+        with open(conf['log']['runlog'], 'r') as f:
+            records = [r for r in (json.loads(l) for l in f if l.strip()) if r['run'] == run_id]
+    print('{0:8} {1:10} {2:>9} {3:>9} {4:>9} {5:>9} {6:>10} {7:>10}  {8}'.format('episode', 'stage', 'wall(s)',
+                                                                          'cpu(s)', 'child(s)', 'rss(MiB)',
+                                                                          'read(MiB)', 'wrote(MiB)', 'exit codes'))
+    for r in records:
+        print('{0:8} {1:10} {2:9.2f} {3:9.2f} {4:9.2f} {5:9.1f} {6:10.1f} {7:10.1f}  {8}{9}'.format(
+                                    str(r['episode']),
+                                    r['stage'],
+                                    r['wall'],
+                                    r['cpu'],
+                                    r['cpu_children'],
+                                    max(r['peak_rss_kb'], r['peak_rss_children_kb']) / 1024,
+                                    r['bytes_read'] / 1048576,
+                                    r['bytes_written'] / 1048576,
+                                    ','.join(str(c[1]) for c in r['exit_codes']),
+                                    ('' if r['ok'] else ' (FAILED)')))
+
 dflt_config_paths = ['~/.podloader.ini',
                     '~/.podloader/podloader.ini',
                     'podloader.ini',
                     'podloader.ini.dist']
 
-def configParse(configfile = dflt_config_paths[-1]):
+# The placeholders [tags]url and [local]subdir can use; see tmplCompile().
+placeholder_re = re.compile('(SEASONEPISODE|SEASON|EPISODE)')
+gpgkey_re = re.compile(r'^\s*(0x)?([0-9A-F]*)\s*')
+title_re = re.compile('[^A-Za-z0-9-]')
+dots_re = re.compile(r'\.+')
+trailing_dot_re = re.compile(r'\.$')
+cc_re = re.compile('CC-?', flags = re.I)
+
+# Parsed configs for this run, {cache file: (files it was parsed from and their states, config dict)}.
+config_cache = {}
+
+def tmplCompile(template):
+    # Splits a template into a list whose odd items are placeholders, which JSONs (for the config cache) just fine.
+    return(placeholder_re.split(template))
+
+def tmplRender(tmpl, values):
+    return(''.join((values[t] if i % 2 else t) for i, t in enumerate(tmpl)))
+
+def configPaths():
+    # dflt_config_paths with ~ expanded and relative paths made relative to this script.
+    here = os.path.dirname(os.path.realpath(__file__))
+    paths = [os.path.expanduser(p) for p in dflt_config_paths]
+    return([(p if p.startswith('/') else '{0}/{1}'.format(here, p)) for p in paths])
+
+def configCacheFile(defconf, conf):
+    # Not under [cache]path, since that comes from the config. It can hold the DB password, hence 0600.
+    cachedir = '{0}/podloader'.format(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')))
+    key = hashlib.sha256('\0'.join((defconf, conf)).encode('utf-8')).hexdigest()[:16]
+    return('{0}/config.{1}.json'.format(cachedir, key))
+
+def configParse(configfile = None, readonly = False):
     # Here we find and parse the config, then return a dict of the values.
     # We COULD return a configparser object, but that's a PITA to reference.
+    # The result is cached (in memory and on disk) until any of the files it came from changes.
+    # With readonly (--check), nothing is written: no disk cache, no [local]mediadir.
+    paths = configPaths()
+    defconf = paths[-1]
     conf = configfile
-    olddef = dflt_config_paths[-1]
-    for i, item in enumerate(dflt_config_paths):
-        dflt_config_paths[i] = os.path.expanduser(item)
-    for i, item in enumerate(dflt_config_paths):
-        if not dflt_config_paths[i].startswith('/'):
-            dflt_config_paths[i] = '{0}/{1}'.format(os.path.dirname(os.path.realpath(__file__)), item)
-    if configfile != olddef:
-        conf = configfile
-    else:
-        for p in dflt_config_paths:
+    if not conf:
+        conf = defconf
+        for p in paths:
             if os.path.isfile(p):
                 conf = p
                 break
-    defconf = dflt_config_paths[-1]
+    conf = os.path.abspath(os.path.expanduser(conf))
+    cachefile = configCacheFile(defconf, conf)
+    cached = config_cache.get(cachefile)
+    if not cached:
+        try:
+            with open(cachefile, 'r') as f:
+                cached = json.load(f)
+        except (FileNotFoundError, ValueError):
+            cached = None
+    if cached and all(fileState(f) == st for f, st in cached[0].items()):
+        config_dict = copy.deepcopy(cached[1])
+    else:
+        config_dict, deps = configRead(defconf, conf)
+        cached = ({f: fileState(f) for f in deps}, config_dict)
+        try:
+            if not readonly:
+                os.makedirs(os.path.dirname(cachefile), mode = 0o700, exist_ok = True)
+                tmpfile = '{0}.{1}'.format(cachefile, os.getpid())
+                with os.fdopen(os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                    json.dump(cached, f)
+                os.replace(tmpfile, cachefile)
+        except OSError:
+            pass
+        config_dict = copy.deepcopy(config_dict)
+    config_cache[cachefile] = cached
+    if not readonly:
+        os.makedirs(config_dict['local']['mediadir'], exist_ok = True)
+    return(config_dict)
+
+def configRead(defconf, conf):
+    # Does the actual parsing/validating for configParse(). Returns the config dict and the
+    # files it depends on (this script included, since it decides what the dict looks like).
+    deps = [os.path.realpath(__file__), defconf, conf]
     config = configparser.ConfigParser()
     config._interpolation = configparser.ExtendedInterpolation()
     config.read([defconf, conf])
@@ -50,16 +216,61 @@ def configParse(configfile = dflt_config_paths[-1]):
     # Convert the booleans to pythonic booleans in the dict, convert to ints, etc.
     if config['mysql']['password'] == 'False':
         config_dict['mysql']['password'] = config['mysql'].getboolean('password')
-    config_dict['gpg']['enabled'] = config['gpg'].getboolean('enabled')
+    for i in ('enabled', 'sums', 'per_file'):
+        config_dict['gpg'][i] = config['gpg'].getboolean(i)
     config_dict['mysql']['port'] = config['mysql'].getint('port')
     config_dict['tags']['season_pad'] = config['tags'].getint('season_pad')
     config_dict['tags']['episode_pad'] = config['tags'].getint('episode_pad')
+    config_dict['transcode']['workers'] = config['transcode'].getint('workers')
+    for i in ('enabled', 'trim'):
+        config_dict['loudness'][i] = config['loudness'].getboolean(i)
+    for i in ('target', 'tp', 'lra', 'silence_db', 'silence_dur'):
+        config_dict['loudness'][i] = config['loudness'].getfloat(i)
+    config_dict['formats']['enabled'] = [f.strip().lower() for f in config_dict['formats']['enabled'].split(',') if f.strip()]
+    for f in config_dict['formats']['enabled']:
+        if f not in output_formats:
+            exit('ERROR: [formats]enabled has {0}, but the formats we know are {1}.'.format(f, ', '.join(output_formats)))
+    if not config_dict['formats']['enabled']:
+        exit('ERROR: [formats]enabled needs at least one format.')
+    for i in ('port', 'streams', 'retries'):
+        config_dict['rsync'][i] = config['rsync'].getint(i)
+    if config_dict['rsync']['method'] not in ('rsync', 'sftp', 'local'):
+        exit('ERROR: [rsync]method must be one of rsync, sftp or local.')
+    config_dict['batch']['workers'] = config['batch'].getint('workers')
+    config_dict['watch']['workers'] = config['watch'].getint('workers')
+    config_dict['distributed']['queue'] = os.path.expanduser(config_dict['distributed']['queue'])
+    config_dict['distributed']['workers'] = config['distributed'].getint('workers')
+    for i in ('stale', 'idle', 'interval', 'timeout'):
+        config_dict['distributed'][i] = config['distributed'].getfloat(i)
+    for i in ('settle', 'interval'):
+        config_dict['watch'][i] = config['watch'].getfloat(i)
+    config_dict['cache']['path'] = os.path.expanduser(config_dict['cache']['path'])
+    config_dict['cache']['transcode_size'] = config['cache'].getint('transcode_size')
+    if config_dict['log']['runlog'].lower() in ('false', 'no', '0', 'off', ''):
+        config_dict['log']['runlog'] = False
+    else:
+        config_dict['log']['runlog'] = os.path.expanduser(config_dict['log']['runlog'])
+    config_dict['log']['summary'] = config['log'].getboolean('summary')
+    config_dict['feed']['enabled'] = config['feed'].getboolean('enabled')
+    config_dict['feed']['path'] = os.path.expanduser(config_dict['feed']['path'])
+    feeds = []
+    for f in config_dict['feed']['feeds'].split(','):
+        f = f.strip().split(':')
+        if len(f) < 2 or f[1] not in output_formats or (len(f) > 2 and f[2] not in feed_ns):
+            exit('ERROR: [feed]feeds should be <file>:<format>[:itunes|google], separated by commas.')
+        feeds.append({'file': f[0], 'format': f[1], 'flavor': (f[2] if len(f) > 2 else None)})
+    config_dict['feed']['feeds'] = feeds
+    if config_dict['mysql']['sqlite'].lower() in ('false', 'no', '0', 'off', ''):
+        config_dict['mysql']['sqlite'] = False
+    else:
+        config_dict['mysql']['sqlite'] = os.path.expanduser(config_dict['mysql']['sqlite'])
     # Set some "magic" interpolation
-    if not config_dict['mysql']['password']:
+    if not config_dict['mysql']['password'] and not config_dict['mysql']['sqlite']:
         config_dict['mysql']['conf'] = os.path.expanduser(config_dict['mysql']['conf'])
         mysqlconf = configparser.ConfigParser(allow_no_value = True)
         if os.path.isfile(config_dict['mysql']['conf']):
             mysqlconf.read(config_dict['mysql']['conf'])
+            deps.append(config_dict['mysql']['conf'])
             mysqlcnf_dict = {s:dict(mysqlconf.items(s)) for s in mysqlconf.sections()}
             mysqlcnf = mysqlcnf_dict['client' + config_dict['mysql']['confsec']]
             if 'host' in mysqlcnf:
@@ -87,23 +298,54 @@ def configParse(configfile = dflt_config_paths[-1]):
             exit('ERROR: You specified [mysql]password as False but did not provide a valid .my.cnf path!')
     config_dict['gpg']['keys'] = config_dict['gpg']['keys'].split(',')
     if len(config_dict['gpg']['keys']) >= 1:
-        config_dict['gpg']['keys'][:] = [re.sub('^\s*(0x)?([0-9A-F]*)\s*',
-                                        '\g<2>', x).upper() for x in config_dict['gpg']['keys']]
+        config_dict['gpg']['keys'][:] = [gpgkey_re.sub(r'\g<2>', x).upper() for x in config_dict['gpg']['keys']]
     if config_dict['gpg']['enabled'] == True:
         if config_dict['gpg']['homedir'] != '':
             config_dict['gpg']['homedir'] = os.path.expanduser(config_dict['gpg']['homedir'])
     config_dict['local']['path'] = os.path.expanduser(config_dict['local']['path'])
     config_dict['local']['mediadir'] = os.path.expanduser(config_dict['local']['mediadir'])
-    os.makedirs(config_dict['local']['mediadir'], exist_ok = True)
     if config_dict['tags']['year'] == 'False':
         config_dict['tags']['year'] = config['tags'].getboolean('year')
     config_dict['tags']['img'] = os.path.expanduser(config_dict['tags']['img'])
-    return(config_dict)
+    config_dict['tags']['img_maxdim'] = config['tags'].getint('img_maxdim')
+    config_dict['tags']['padding'] = config['tags'].getint('padding')
+    config_dict['templates'] = {'url': tmplCompile(config_dict['tags']['url']),
+                                'subdir': tmplCompile(config_dict['local']['subdir'])}
+    return(config_dict, deps)
+
+episode_re = re.compile('^S([0-9]+)E([0-9]+)$')
+silence_re = re.compile('silence_(start|end): *(-?[0-9.]+)')
 
-def confArgs(conf, args):
+def flacInfo(flacfile):
+    # Reads just the STREAMINFO block (which the spec requires to come first) instead of spawning
+    # metaflac for every field. Returns None if it isn't a FLAC at all.
+    with open(flacfile, 'rb') as f:
+        head = f.read(4)
+        if head[:3] == b'ID3':
+            # Some taggers stick an ID3v2 tag on the front anyways; skip over it.
+            hdr = f.read(6)
+            size = (hdr[2] << 21) | (hdr[3] << 14) | (hdr[4] << 7) | hdr[5]
+            f.seek(10 + size + (10 if hdr[1] & 0x10 else 0))
+            head = f.read(4)
+        if head != b'fLaC':
+            return(None)
+        block = f.read(4 + 34)
+    if len(block) < 38 or (block[0] & 0x7f) != 0:
+        return(None)
+    # 16 bits min/max block size, 24 bits min/max frame size, then 20 bits sample rate,
+    # 3 bits (channels - 1), 5 bits (bits per sample - 1), 36 bits total samples and the 128-bit MD5.
+    packed = struct.unpack('>Q', block[14:22])[0]
+    return({'rate': packed >> 44,
+            'channels': ((packed >> 41) & 0x07) + 1,
+            'depth': ((packed >> 36) & 0x1f) + 1,
+            'samples': packed & 0xfffffffff,
+            'md5': block[22:38].hex()})
+
+def confArgs(conf, args, readonly = False):
+    # readonly is for --check; see configParse().
     conf['episode'] = {}
     conf['episode']['title'] = args.title
-    conf['episode']['file_title'] = re.sub('[^A-Za-z0-9-]', '.', conf['episode']['title']).lower()
+    conf['episode']['file_title'] = title_re.sub('.', conf['episode']['title']).lower()
     conf['episode']['season'] = str(args.season).zfill(conf['tags']['season_pad'])
     conf['episode']['serial'] = str(args.episode).zfill(conf['tags']['episode_pad'])
     for i in ('season', 'episode'):
@@ -113,30 +355,17 @@ def confArgs(conf, args):
     conf['episode']['pretty_title'] = '{0}: {1}'.format(conf['episode']['id'], conf['episode']['title'])
     if conf['tags']['track'] == 'EPISODE':
         conf['tags']['track'] = conf['episode']['serial']
-    conf['tags']['url'] = re.sub('^(.*)SEASONEPISODE(.*)$',
-                                '\g<1>' + conf['episode']['id'] + '\g<2>',
-                                conf['tags']['url'])
-    conf['tags']['url'] = re.sub('^(.*)SEASON(.*)$',
-                                '\g<1>' + conf['episode']['season'] + '\g<2>',
-                                conf['tags']['url'])
-    conf['tags']['url'] = re.sub('^(.*)EPISODE(.*)$',
-                                '\g<1>' + conf['episode']['serial'] + '\g<2>',
-                                conf['tags']['url'])
-    conf['local']['subdir'] = re.sub('^(.*)SEASONEPISODE(.*)$',
-                                '\g<1>' + conf['episode']['id'] + '\g<2>',
-                                conf['local']['subdir'])
-    conf['local']['subdir'] = re.sub('^(.*)SEASON(.*)$',
-                                '\g<1>' + conf['episode']['season'] + '\g<2>',
-                                conf['local']['subdir'])
-    conf['local']['subdir'] = re.sub('^(.*)EPISODE(.*)$',
-                                '\g<1>' + conf['episode']['serial'] + '\g<2>',
-                                conf['local']['subdir'])
+    values = {'SEASONEPISODE': conf['episode']['id'],
+              'SEASON': conf['episode']['season'],
+              'EPISODE': conf['episode']['serial']}
+    conf['tags']['url'] = tmplRender(conf['templates']['url'], values)
+    conf['local']['subdir'] = tmplRender(conf['templates']['subdir'], values)
     conf['local']['path'] = '{0}/{1}'.format(conf['local']['path'],
                                             conf['local']['subdir'].lower())
     if not conf['tags']['year']:
         conf['tags']['year'] = datetime.datetime.now().year
     conf['tags']['year'] = str(conf['tags']['year'])
-    if not os.path.isdir(conf['local']['path']):
+    if not os.path.isdir(conf['local']['path']) and not readonly:
         os.makedirs(conf['local']['path'], exist_ok = True)
     del conf['local']['subdir']
     conf['episode']['raw'] = args.flacfile
@@ -156,19 +385,11 @@ def confArgs(conf, args):
                 break
         if not conf['episode']['raw']:
             exit('ERROR: We cannot seem to locate a FLAC to convert. Try using the -f/--file argument.')
-    magic_file = magic.open(magic.MAGIC_MIME)
-    magic_file.load()
-    if magic_file.file(conf['episode']['raw']) not in ('audio/x-flac; charset=binary',
-                                                       'audio/flac; charset=binary'):
+    conf['flac'] = flacInfo(conf['episode']['raw'])
+    if not conf['flac']:
         exit('ERROR: Your FLAC file does not seem to actually be FLAC.')
-    conf['flac'] = {}
-    conf['flac']['samples'] = subprocess.check_output(['metaflac',
-                                                            '--show-total-samples',
-                                                            '{0}'.format(conf['episode']['raw'])]).decode('utf-8').strip()
-    conf['flac']['rate'] = subprocess.check_output(['metaflac',
-                                                            '--show-sample-rate',
-                                                            '{0}'.format(conf['episode']['raw'])]).decode('utf-8').strip()
-    conf['flac']['rate'] = '{0:.2f}'.format(float(conf['flac']['rate']))
+    if not conf['flac']['rate']:
+        exit('ERROR: Your FLAC file has an invalid sample rate in its STREAMINFO.')
     rawfilepath = os.path.abspath(os.path.expanduser(args.raw_recording))
     if not os.path.isfile(rawfilepath):
         exit('ERROR: the raw recording evaluated to {0} but it does not seem to exist!'.format(rawfilepath))
@@ -184,11 +405,10 @@ def confArgs(conf, args):
     conf['episode']['released'] = (str(datetime.datetime.utcnow())).split('.')[0]
     conf['episode']['month'] = datetime.datetime.fromtimestamp(timestamp).strftime('%m')
     conf['episode']['day'] = datetime.datetime.fromtimestamp(timestamp).strftime('%d')
-    conf['episode']['file_title'] = re.sub('\.+', '.', conf['episode']['file_title'])
+    conf['episode']['file_title'] = dots_re.sub('.', conf['episode']['file_title'])
     conf['episode']['file_title'] = '{0}.{1}'.format(conf['episode']['id'].lower(),
-                                                    re.sub('\.$',
-                                                        '',
-                                                        conf['episode']['file_title']))
+                                                    trailing_dot_re.sub('', conf['episode']['file_title']))
+    conf['episode']['streaminfo'] = conf['flac']
     del conf['flac']
     if args.editor:
         del conf['tags']['editor']
@@ -200,7 +420,8 @@ def confArgs(conf, args):
     conf['local']['mediadir'] = '{0}/S{1}/E{2}'.format(conf['local']['mediadir'],
                                                     conf['episode']['season'],
                                                     conf['episode']['serial'])
-    os.makedirs(conf['local']['mediadir'], exist_ok = True)
+    if not readonly:
+        os.makedirs(conf['local']['mediadir'], exist_ok = True)
     cc_base_url = 'https://creativecommons.org/licenses'
     conf['music'] = {}
     conf['music']['intro'] = {}
@@ -211,7 +432,7 @@ def confArgs(conf, args):
     if args.intro_copyrightlink:
         conf['music']['intro']['copyrightlink'] = args.intro_copyrightlink
     else:
-        strp_cr = (re.sub('CC-?', '', args.intro_copyright, flags = re.I)).split()
+        strp_cr = (cc_re.sub('', args.intro_copyright)).split()
         if len(strp_cr) != 2:
             exit('ERROR: You did not specify a copyright link and this does not seem to be a CC license!')
         conf['music']['intro']['copyrightlink'] = '{0}/{1}/{2}/'.format(
@@ -226,15 +447,114 @@ def confArgs(conf, args):
     if args.intro_copyrightlink:
         conf['music']['outro']['copyrightlink'] = args.outro_copyrightlink
     else:
-        strp_cr = (re.sub('CC-?', '', args.outro_copyright, flags = re.I)).split()
+        strp_cr = (cc_re.sub('', args.outro_copyright)).split()
         conf['music']['outro']['copyrightlink'] = '{0}/{1}/{2}/'.format(
                                                     cc_base_url,
                                                     strp_cr[0].lower(),
                                                     strp_cr[1])
     return(conf)
 
-def transcodeMP3(conf):
-    mediatype = 'mp3'
+def flacSHA(conf):
+    # The FLAC's SHA256, which the analysis and transcode caches are keyed on. Only hashed once per run.
+    if not conf['episode'].get('flacsha'):
+        conf['episode']['flacsha'] = getSHA256(conf['episode']['raw'])
+    return(conf['episode']['flacsha'])
+
+def measureFLAC(conf):
+    # The expensive part of analyze(): one ffmpeg pass over the whole FLAC for both silencedetect
+    # and the first (measuring) pass of loudnorm. Returns the loudnorm stats and the silences.
+    ln = conf['loudness']
+    afilter = 'silencedetect=noise={0}dB:d={1},loudnorm=I={2}:TP={3}:LRA={4}:print_format=json'.format(
+                                                ln['silence_db'], ln['silence_dur'], ln['target'], ln['tp'], ln['lra'])
+    print('{0}: Measuring loudness and silence in {1}...'.format(datetime.datetime.now(), conf['episode']['raw']))
+    proc = subprocess.run(['ffmpeg', '-nostats', '-hide_banner', '-i', conf['episode']['raw'],
+                           '-af', afilter, '-f', 'null', '-'],
+                          stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+    if logExit('ffmpeg', proc.returncode) != 0:
+        exit('ERROR: ffmpeg exited with status {0} while analyzing {1}.'.format(proc.returncode, conf['episode']['raw']))
+    out = proc.stderr.decode('utf-8', 'replace')
+    stats = json.loads(out[out.rindex('{'):out.rindex('}') + 1])
+    silences = []
+    for line in out.splitlines():
+        m = silence_re.search(line)
+        if not m:
+            continue
+        if m.group(1) == 'start':
+            silences.append([float(m.group(2)), None])
+        elif silences:
+            silences[-1][1] = float(m.group(2))
+    return(stats, silences)
+
+def analyze(conf):
+    # Two-pass EBU R128 loudness normalization (see [loudness]) and leading/trailing silence trimming.
+    # The measurements are cached on the FLAC's SHA256 and the settings, so they're only done once;
+    # every format's encode then uses the same filter (see transcodeAll()). Returns the analysis dict.
+    ln = conf['loudness']
+    key = hashlib.sha256(json.dumps([flacSHA(conf), ln], sort_keys = True).encode('utf-8')).hexdigest()
+    cachefile = '{0}/analysis/{1}.json'.format(conf['cache']['path'], key)
+    try:
+        with open(cachefile, 'r') as f:
+            analysis = json.load(f)
+        print('{0}: Reusing the cached loudness/silence analysis.'.format(datetime.datetime.now()))
+    except (FileNotFoundError, ValueError):
+        stats, silences = measureFLAC(conf)
+        length = conf['episode']['streaminfo']['samples'] / conf['episode']['streaminfo']['rate']
+        start, end = 0.0, length
+        if ln['trim']:
+            # Only silence touching the very start/end is trimmed; anything in between is left alone.
+            if silences and silences[0][0] <= 0.05:
+                start = silences[0][1] or length
+            if silences and (silences[-1][1] is None or silences[-1][1] >= length - 0.05):
+                end = silences[-1][0]
+            if end <= start:
+                start, end = 0.0, length
+        analysis = {'input_i': float(stats['input_i']),
+                    'input_tp': float(stats['input_tp']),
+                    'input_lra': float(stats['input_lra']),
+                    'input_thresh': float(stats['input_thresh']),
+                    'target_offset': float(stats['target_offset']),
+                    'start': round(start, 3),
+                    'end': round(end, 3)}
+        os.makedirs(os.path.dirname(cachefile), exist_ok = True)
+        tmpfile = '{0}.{1}'.format(cachefile, os.getpid())
+        with open(tmpfile, 'w') as f:
+            json.dump(analysis, f)
+        os.replace(tmpfile, cachefile)
+    # The second pass happens as part of the encode. loudnorm works at 192kHz internally, hence the aresample.
+    afilter = []
+    length = conf['episode']['streaminfo']['samples'] / conf['episode']['streaminfo']['rate']
+    if analysis['start'] > 0 or analysis['end'] < length:
+        afilter.append('atrim=start={0}:end={1},asetpts=PTS-STARTPTS'.format(analysis['start'], analysis['end']))
+    afilter.append(('loudnorm=I={0}:TP={1}:LRA={2}:measured_I={3}:measured_TP={4}:measured_LRA={5}:'
+                    'measured_thresh={6}:offset={7}:linear=true:print_format=none').format(
+                                                ln['target'], ln['tp'], ln['lra'],
+                                                analysis['input_i'], analysis['input_tp'], analysis['input_lra'],
+                                                analysis['input_thresh'], analysis['target_offset']))
+    afilter.append('aresample={0}'.format(conf['episode']['streaminfo']['rate']))
+    analysis['afilter'] = ','.join(afilter)
+    logValues(lufs = analysis['input_i'],
+              true_peak = analysis['input_tp'],
+              lra = analysis['input_lra'],
+              trim_start = analysis['start'],
+              trim_end = round(length - analysis['end'], 3))
+    print('{0}: {1} is {2} LUFS (true peak {3} dBTP); normalizing to {4} LUFS{5}.'.format(
+                                                datetime.datetime.now(),
+                                                conf['episode']['id'],
+                                                analysis['input_i'],
+                                                analysis['input_tp'],
+                                                ln['target'],
+                                                (', trimming {0:.2f}s/{1:.2f}s of silence'.format(analysis['start'],
+                                                                                                 length - analysis['end'])
+                                                 if analysis['start'] > 0 or analysis['end'] < length else '')))
+    return(analysis)
+
+def filterArgs(conf):
+    # The ffmpeg -af arguments from analyze(), if any.
+    if conf['episode'].get('afilter'):
+        return(['-af', conf['episode']['afilter']])
+    return([])
+
+def mediaFile(conf, mediatype):
     mediadir = '{0}/{1}'.format(conf['local']['mediadir'], mediatype)
     mediafile = '{0}/{1}.{2}'.format(mediadir,
                                     conf['episode']['file_title'],
@@ -242,80 +562,272 @@ def transcodeMP3(conf):
     if os.path.isfile(mediafile):
         os.remove(mediafile)
     os.makedirs(mediadir, exist_ok = True)
-    print('{0}: Transcoding to {1}...'.format(datetime.datetime.now(), mediatype))
-    subprocess.call(['ffmpeg', '-stats', '-loglevel', '0', '-i',
-                    conf['episode']['raw'], '-b:a', '128k', '-ac','1', '-joint_stereo', '1',
-                    mediafile])
     return(mediafile)
 
-def transcodeOGG(conf):
-    mediatype = 'ogg'
-    mediadir = '{0}/{1}'.format(conf['local']['mediadir'], mediatype)
-    mediafile = '{0}/{1}.{2}'.format(mediadir,
-                                    conf['episode']['file_title'],
-                                    mediatype)
-    if os.path.isfile(mediafile):
-        os.remove(mediafile)
-    os.makedirs(mediadir, exist_ok = True)
+def transcode(conf, mediatype):
+    # Decodes the FLAC itself; use transcodeAll() to share one decode between formats.
+    mediafile = mediaFile(conf, mediatype)
     print('{0}: Transcoding to {1}...'.format(datetime.datetime.now(), mediatype))
-    subprocess.call(['ffmpeg', '-stats', '-loglevel', '0', '-i',
-                    conf['episode']['raw'], '-qscale:a', '8', '-ac','1', '-joint_stereo', '1',
-                    mediafile])
+    start = time.time()
+    ret = logExit('ffmpeg', subprocess.call(['ffmpeg', '-stats', '-loglevel', '0', '-i',
+                           conf['episode']['raw']] + filterArgs(conf) +
+                           output_formats[mediatype]['args'] + [mediafile]))
+    if ret != 0:
+        exit('ERROR: ffmpeg exited with status {0} while transcoding to {1}.'.format(ret, mediatype))
+    print('{0}: Transcoded to {1} in {2:.2f} seconds.'.format(datetime.datetime.now(),
+                                                             mediatype,
+                                                             time.time() - start))
     return(mediafile)
 
-def imgConv(imgfile):
+def transcodeMP3(conf):
+    return(transcode(conf, 'mp3'))
+
+def transcodeOGG(conf):
+    return(transcode(conf, 'ogg'))
+
+def fanOut(conf, mediafiles):
+    # Decode the FLAC once (to lossless PCM in NUT, which streams cleanly over a pipe)
+    # and feed the same stream to one encoder process per format, all running at once.
+    decoder = subprocess.Popen(['ffmpeg', '-nostats', '-loglevel', '0', '-i',
+                                conf['episode']['raw']] + filterArgs(conf) + ['-c:a', 'pcm_s32le', '-f', 'nut', '-'],
+                               stdout = subprocess.PIPE)
+    encoders = {}
+    start = time.time()
+    for mediatype, mediafile in mediafiles.items():
+        print('{0}: Transcoding to {1}...'.format(datetime.datetime.now(), mediatype))
+        encoders[mediatype] = subprocess.Popen(['ffmpeg', '-nostats', '-loglevel', '0',
+                                                '-f', 'nut', '-i', '-'] +
+                                               output_formats[mediatype]['args'] + [mediafile],
+                                               stdin = subprocess.PIPE)
+    def waitEnc(mediatype):
+        ret = logExit('ffmpeg', encoders[mediatype].wait())
+        return(ret, time.time() - start)
+    with ThreadPoolExecutor(max_workers = len(encoders)) as pool:
+        results = {m: pool.submit(waitEnc, m) for m in encoders}
+        feeding = list(encoders.keys())
+        for chunk in iter(lambda: decoder.stdout.read(1048576), b''):
+            for mediatype in feeding[:]:
+                try:
+                    encoders[mediatype].stdin.write(chunk)
+                except BrokenPipeError:
+                    feeding.remove(mediatype)
+            if not feeding:
+                break
+        decoder.stdout.close()
+        for mediatype in encoders:
+            try:
+                encoders[mediatype].stdin.close()
+            except BrokenPipeError:
+                pass
+        decret = logExit('ffmpeg', decoder.wait())
+        results = {m: results[m].result() for m in results}
+    if decret not in (0, -13):  # -13 is SIGPIPE, i.e. all the encoders quit early
+        exit('ERROR: ffmpeg exited with status {0} while decoding {1}.'.format(decret, conf['episode']['raw']))
+    for mediatype, (ret, elapsed) in results.items():
+        if ret != 0:
+            exit('ERROR: ffmpeg exited with status {0} while transcoding to {1}.'.format(ret, mediatype))
+        print('{0}: Transcoded to {1} in {2:.2f} seconds.'.format(datetime.datetime.now(),
+                                                                 mediatype,
+                                                                 elapsed))
+
+def transcodeKey(flacsha, mediatype, afilter = None):
+    # A cached encode is only valid for the exact same FLAC *and* the exact same filter/encoder settings.
+    key = hashlib.sha256()
+    key.update(flacsha.encode('utf-8'))
+    key.update('\0'.join([mediatype] + output_formats[mediatype]['args']).encode('utf-8'))
+    if afilter:
+        key.update(afilter.encode('utf-8'))
+    return(key.hexdigest())
+
+def cacheEvict(cachedir, maxsize):
+    # LRU; cacheGet() bumps the mtime of an entry every time it's used.
+    entries = []
+    total = 0
+    with os.scandir(cachedir) as it:
+        for e in it:
+            if e.is_file() and not e.name.startswith('.'):
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+    entries.sort()
+    while total > maxsize and entries:
+        mtime, size, path = entries.pop(0)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def cacheGet(cachefile, mediafile):
+    try:
+        shutil.copyfile(cachefile, mediafile)
+    except FileNotFoundError:
+        return(False)
+    os.utime(cachefile)
+    return(True)
+
+def cachePut(mediafile, cachefile, maxsize):
+    cachedir = os.path.dirname(cachefile)
+    os.makedirs(cachedir, exist_ok = True)
+    tmpfile = '{0}/.{1}.{2}'.format(cachedir, os.path.basename(cachefile), os.getpid())
+    shutil.copyfile(mediafile, tmpfile)
+    os.replace(tmpfile, cachefile)
+    cacheEvict(cachedir, maxsize)
+
+def transcodeAll(conf):
+    # Returns a dict of {mediatype: mediafile}. With [transcode]workers of 2 or more,
+    # up to that many formats are encoded concurrently from a single decode of the FLAC.
+    # Untagged encodes are cached (see [cache]), so re-runs after e.g. a title fix only re-tag.
+    mediafiles = {}
+    for mediatype in conf['formats']['enabled']:
+        mediafiles[mediatype] = mediaFile(conf, mediatype)
+    cachefiles = {}
+    maxsize = conf['cache']['transcode_size'] * 1048576
+    if maxsize > 0:
+        flacsha = flacSHA(conf)
+        for mediatype in conf['formats']['enabled']:
+            cachefiles[mediatype] = '{0}/transcode/{1}.{2}'.format(conf['cache']['path'],
+                                                                  transcodeKey(flacsha, mediatype,
+                                                                               conf['episode'].get('afilter')),
+                                                                  mediatype)
+    pending = []
+    for mediatype, mediafile in mediafiles.items():
+        if mediatype in cachefiles and cacheGet(cachefiles[mediatype], mediafile):
+            print('{0}: Reusing cached {1} transcode.'.format(datetime.datetime.now(), mediatype))
+        else:
+            pending.append(mediatype)
+    workers = conf['transcode']['workers']
+    if workers < 2 or len(pending) < 2:
+        for mediatype in pending:
+            transcode(conf, mediatype)
+    else:
+        for i in range(0, len(pending), workers):
+            fanOut(conf, {m: mediafiles[m] for m in pending[i:i + workers]})
+    for mediatype in pending:
+        if mediatype in cachefiles:
+            cachePut(mediafiles[mediatype], cachefiles[mediatype], maxsize)
+    return(mediafiles)
+
+def imgConv(imgfile, maxdim = 0):
     # Rockbox (and probably some other clients) don't like progressive JPEGs and stuff. SO let's fix that.
     # Thanks to the io module, we don't even need to write a new file out.
+    # If maxdim is set, art bigger than maxdim x maxdim is also scaled down (keeping the aspect ratio).
+    from PIL import Image  # This is really pillowtalk for what I'm using. I don't think PIL proper ever released a py3k version.
     img_meta = {}
-    magic_file = magic.open(magic.MAGIC_MIME)
-    magic_file.load()
-    img_meta['mime'] = magic_file.file(imgfile).split(';')[0]
-    with Image.open(imgfile) as img_data:
-        img_meta['height'] = img_data.height
-        img_meta['width'] = img_data.width
-        img_meta['depth'] = img_data.bits
+    with open(imgfile, 'rb') as f:
+        img_stream = f.read()
+    with Image.open(BytesIO(img_stream)) as img_data:
+        img_meta['mime'] = Image.MIME.get(img_data.format, 'image/jpeg')
+        img_meta['depth'] = getattr(img_data, 'bits', 8)
+        resize = (maxdim and max(img_data.size) > maxdim)
         # And we need to remove the progressiveness if it exists.
-        if 'progressive' in img_data.info.keys():
+        if 'progressive' in img_data.info.keys() or resize:
             # This isn't strictly necessary since we explicitly specify format = 'JPEG' when saving.
             #if p.format in ('JPEG', 'PNG'):
             #    imgformat = img_data.format
             #else:
             #    imgformat = 'PNG'
-            img_stream = BytesIO()
-            img_data.save(img_stream,
+            info = img_data.info
+            if resize:
+                img_data.thumbnail((maxdim, maxdim), Image.LANCZOS)
+            if img_data.mode not in ('RGB', 'L', 'CMYK'):
+                img_data = img_data.convert('RGB')
+            img_buf = BytesIO()
+            img_data.save(img_buf,
                           format = 'JPEG',
-                          dpi = img_data.info.get('dpi'),
+                          dpi = info.get('dpi', (0, 0)),
                           quality = 95,
                           optimize = True,
                           progressive = False,
-                          icc_profile = img_data.info.get('icc_profile'),
-                          subsampling = 'keep')
+                          icc_profile = info.get('icc_profile'),
+                          subsampling = ('keep' if img_meta['mime'] == 'image/jpeg' and not resize else 0))
             # Be kind, please rewind.
             # Don't sue me, Blockbuster. lol
-            img_stream.seek(0)
-            img_stream = img_stream.read()
-        else:
-            with open(imgfile) as f:
-                img_stream = f.read()
+            img_buf.seek(0)
+            img_stream = img_buf.read()
+            img_meta['mime'] = 'image/jpeg'
+        img_meta['width'], img_meta['height'] = img_data.size
     return(img_stream, img_meta)
 
+# The processed cover art for this run. See coverArt().
+cover_cache = {}
+
+def coverArt(conf):
+    # Converts the cover art (see imgConv()) and builds the FLAC picture block for OGG only once.
+    # The result is kept in memory for the rest of the run and on disk under [cache]path/art/,
+    # keyed on the image's path, mtime and SHA256 (plus the settings that change the output).
+    imgfile = conf['tags']['img']
+    maxdim = conf['tags']['img_maxdim']
+    desc = '{0} ({1})'.format(conf['tags']['artist'], conf['tags']['comment'])
+    st = os.stat(imgfile)
+    memkey = (imgfile, st.st_mtime, st.st_size, maxdim, desc)
+    if memkey in cover_cache:
+        return(cover_cache[memkey])
+    imgsha = getHash(imgfile)[0]
+    diskkey = hashlib.sha256('\0'.join([str(i) for i in memkey] + [imgsha]).encode('utf-8')).hexdigest()
+    cachedir = '{0}/art'.format(conf['cache']['path'])
+    cachefile = '{0}/{1}.json'.format(cachedir, diskkey)
+    if os.path.isfile(cachefile):
+        with open(cachefile, 'r') as f:
+            art = json.load(f)
+        art['data'] = base64.b64decode(art['data'])
+        cover_cache[memkey] = art
+        return(art)
+    print('{0}: Converting cover art {1}...'.format(datetime.datetime.now(), imgfile))
+    with instrument(conf, 'imgConv'):
+        img_stream, img_meta = imgConv(imgfile, maxdim = maxdim)
+    art = dict(img_meta)
+    art['data'] = img_stream
+    art['desc'] = desc
+    # https://wiki.xiph.org/VorbisComment#METADATA_BLOCK_PICTURE
+    from mutagen.flac import Picture
+    picture = Picture()
+    picture.data = img_stream
+    picture.type = 3
+    picture.desc = desc
+    picture.mime = img_meta['mime']
+    picture.width = img_meta['width']
+    picture.height = img_meta['height']
+    picture.depth = img_meta['depth']
+    art['picture'] = base64.b64encode(picture.write()).decode('ascii')
+    os.makedirs(cachedir, exist_ok = True)
+    tmpfile = '{0}/.{1}.{2}'.format(cachedir, os.path.basename(cachefile), os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(dict(art, data = base64.b64encode(img_stream).decode('ascii')), f)
+    os.replace(tmpfile, cachefile)
+    cover_cache[memkey] = art
+    return(art)
+
+def tagState(tag):
+    # Everything in a (mutagen) tag, to tell whether setting it all again actually changed anything.
+    return(sorted((str(k), repr(v)) for k, v in tag.items()))
+
+def tagSave(conf, tag, before):
+    # Only writes the tag if it changed. It keeps at least [tags]padding bytes of padding after the tag,
+    # so that later changes (e.g. by -R/--retag) can be written in place instead of rewriting the whole file.
+    # Returns whether the file was written.
+    if tagState(tag) == before:
+        return(False)
+    tag.save(padding = lambda info: (info.padding if info.padding >= 0 else conf['tags']['padding']))
+    return(True)
 
 def tagMP3(conf, mediafile):
     # http://id3.org/id3v2.3.0#Attached_picture
     # http://id3.org/id3v2.4.0-frames (section 4.14)
     # https://stackoverflow.com/questions/7275710/mutagen-how-to-detect-and-embed-album-art-in-mp3-flac-and-mp4
     # https://stackoverflow.com/questions/409949/how-do-you-embed-album-art-into-an-mp3-using-python
-    img_stream, img_meta = imgConv(conf['tags']['img'])
+    from mutagen.id3 import ID3, APIC, TALB, TDRC, TENC, TRCK, COMM, WXXX, TCON, TIT2, TPE1, TCOP
+    art = coverArt(conf)
     print('{0}: Now adding tags to {1}...'.format(datetime.datetime.now(), mediafile))
     tag = ID3(mediafile)
+    before = tagState(tag)
     tag.add(TALB(encoding = 3,
                  text = [conf['tags']['album']]))
     tag.add(APIC(encoding = 3,
-                 mime = img_meta['mime'],
+                 mime = art['mime'],
                  type = 3,
-                 desc = '{0} ({1})'.format(conf['tags']['artist'],
-                                           conf['tags']['comment']),
-                 data = img_stream))
+                 desc = art['desc'],
+                 data = art['data']))
     tag.add(TDRC(encoding = 3,
                  text = ['{0}.{1}.{2}'.format(conf['tags']['year'],
                                               conf['episode']['month'],
@@ -340,30 +852,26 @@ def tagMP3(conf, mediafile):
                  text = [conf['tags']['artist']]))
     tag.add(TCOP(encoding = 3,
                  text = [conf['tags']['copyright']]))
-    tag.save()
+    return(tagSave(conf, tag, before))
 
 def tagOGG(conf, mediafile):
     # https://mutagen.readthedocs.io/en/latest/user/vcomment.html
     # https://wiki.xiph.org/VorbisComment#METADATA_BLOCK_PICTURE
     # https://xiph.org/flac/format.html#metadata_block_picture
     # https://github.com/quodlibet/mutagen/issues/200
-    img_stream, img_meta = imgConv(conf['tags']['img'])
-    picture = Picture()
-    picture.data = img_stream
-    picture.type = 3
-    picture.description = '{0} ({1})'.format(conf['tags']['artist'],
-                                             conf['tags']['comment'])
-    picture.mime = img_meta['mime']
-    picture.width = img_meta['width']
-    picture.height = img_meta['height']
-    picture.depth = img_meta['depth']
-    picture.desc = '{0} ({1})'.format(conf['tags']['artist'],
-                                      conf['tags']['comment'])
-    containered_data = picture.write()
-    encoded_data = base64.b64encode(containered_data)
-    img_tag = encoded_data.decode('ascii')
+    from mutagen.oggvorbis import OggVorbis
+    return(vorbisComments(conf, OggVorbis(mediafile), mediafile))
+
+def tagOpus(conf, mediafile):
+    # Opus uses the same Vorbis comments (and picture block) as OGG Vorbis does.
+    # https://tools.ietf.org/html/rfc7845#section-5.2
+    from mutagen.oggopus import OggOpus
+    return(vorbisComments(conf, OggOpus(mediafile), mediafile))
+
+def vorbisComments(conf, tag, mediafile):
+    art = coverArt(conf)
     print('{0}: Now adding tags to {1}...'.format(datetime.datetime.now(), mediafile))
-    tag = OggVorbis(mediafile)
+    before = tagState(tag)
     tag['TITLE'] = conf['episode']['pretty_title']
     tag['ARTIST'] = conf['tags']['artist']
     tag['ALBUM'] = conf['tags']['album']
@@ -377,131 +885,1015 @@ def tagOGG(conf, mediafile):
     tag['CONTACT'] = conf['tags']['url']
     tag['ENCODED-BY'] = conf['tags']['encoded']
     tag['ENCODER'] = conf['tags']['encoded']
-    tag['METADATA_BLOCK_PICTURE'] = [img_tag]
-    tag.save()
+    tag['METADATA_BLOCK_PICTURE'] = [art['picture']]
+    return(tagSave(conf, tag, before))
+
+def tagM4A(conf, mediafile):
+    # https://mutagen.readthedocs.io/en/latest/api/mp4.html
+    # There's no standard atom for the URL, so it goes in a freeform one like iTunes does for its own extras.
+    from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
+    art = coverArt(conf)
+    print('{0}: Now adding tags to {1}...'.format(datetime.datetime.now(), mediafile))
+    tag = MP4(mediafile)
+    if tag.tags is None:
+        tag.add_tags()
+    before = tagState(tag)
+    # Text atoms are lists (that's how they're read back, too).
+    tag['\xa9nam'] = [conf['episode']['pretty_title']]
+    tag['\xa9ART'] = [conf['tags']['artist']]
+    tag['\xa9alb'] = [conf['tags']['album']]
+    tag['\xa9day'] = ['{0}.{1}.{2}'.format(conf['tags']['year'],
+                                          conf['episode']['month'],
+                                          conf['episode']['day'])]
+    if str(conf['tags']['track']).isdigit():
+        tag['trkn'] = [(int(conf['tags']['track']), 0)]
+    tag['\xa9gen'] = [conf['tags']['genre']]
+    tag['\xa9cmt'] = [conf['tags']['comment']]
+    tag['cprt'] = [conf['tags']['copyright']]
+    tag['\xa9too'] = [conf['tags']['encoded']]
+    tag['----:com.apple.iTunes:URL'] = [MP4FreeForm(conf['tags']['url'].encode('utf-8'))]
+    tag['covr'] = [MP4Cover(art['data'], imageformat = (MP4Cover.FORMAT_PNG if art['mime'] == 'image/png'
+                                                           else MP4Cover.FORMAT_JPEG))]
+    return(tagSave(conf, tag, before))
+
+# The output formats podloader knows how to make; [formats]enabled picks which ones are.
+# Each has the ffmpeg encoder arguments, the function that tags it and the [mysql] columns
+# for its SHA256 and size. (The mp3/ogg columns are part of [mysql]cols already; the others
+# are appended when they're enabled, see dbCols().)
+output_formats = {'mp3': {'args': ['-b:a', '128k', '-ac', '1', '-joint_stereo', '1'],
+                          'tagger': tagMP3,
+                          'mime': 'audio/mpeg',
+                          'cols': ('sha_mp3', 'bytesize_mp3')},
+                  'ogg': {'args': ['-qscale:a', '8', '-ac', '1', '-joint_stereo', '1'],
+                          'tagger': tagOGG,
+                          'mime': 'audio/ogg',
+                          'cols': ('sha_ogg', 'bytesize_ogg')},
+                  # Opus is transparent for speech at well under half the MP3 bitrate.
+                  'opus': {'args': ['-c:a', 'libopus', '-b:a', '48k', '-ac', '1', '-application', 'audio'],
+                           'tagger': tagOpus,
+                           'mime': 'audio/ogg; codecs=opus',
+                           'cols': ('sha_opus', 'bytesize_opus')},
+                  # +faststart puts the index up front so players can start before it's all downloaded.
+                  'm4a': {'args': ['-c:a', 'aac', '-b:a', '96k', '-ac', '1', '-movflags', '+faststart'],
+                          'tagger': tagM4A,
+                          'mime': 'audio/mp4',
+                          'cols': ('sha_m4a', 'bytesize_m4a')}}
+
+# How much to read at a time when hashing. hashlib releases the GIL for updates this size,
+# so hashAll() can hash several files in parallel threads.
+hash_bufsize = 1048576
+
+def getHash(mediafile):
+    # Returns (sha256 hexdigest, size in bytes) from a single pass over the file.
+    filehash = hashlib.sha256()
+    filesize = 0
+    buf = bytearray(hash_bufsize)
+    view = memoryview(buf)
+    with open(mediafile, 'rb', buffering = 0) as f:
+        for n in iter(lambda: f.readinto(buf), 0):
+            filehash.update(view[:n])
+            filesize += n
+    return(filehash.hexdigest(), filesize)
+
+def hashAll(mediafiles):
+    # mediafiles is a dict of {mediatype: mediafile}; returns {mediatype: (sha256, size)}.
+    for mediafile in mediafiles.values():
+        print('{0}: Generating SHA256 for {1}...'.format(datetime.datetime.now(),
+                                                        mediafile))
+    with ThreadPoolExecutor(max_workers = max(len(mediafiles), 1)) as pool:
+        jobs = {m: pool.submit(getHash, f) for m, f in mediafiles.items()}
+        return({m: j.result() for m, j in jobs.items()})
 
 def getSHA256(mediafile):
     print('{0}: Generating SHA256 for {1}...'.format(datetime.datetime.now(),
                                                     mediafile))
-    filehash = hashlib.sha256()
-    with open(mediafile, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b''):
-            filehash.update(chunk)
-    return(filehash.hexdigest())
+    return(getHash(mediafile)[0])
 
 def getSize(mediafile):
     filesize = os.path.getsize(mediafile)
     return(filesize)
 
-def dbEntry(conf):
-    print('{0}: Inserting into the {1}.{2}@{3} table...'.format(datetime.datetime.now(),
-                                                                conf['mysql']['db'],
-                                                                conf['mysql']['table'],
-                                                                conf['mysql']['host']))
-    ssl = False
-    if 'ssl' in conf['mysql']:
-        ssl = conf['mysql']['ssl']
-    vals = "'{0}','{1}','{2}','{3}','{4}','{5}','{6}','{7}','{8}','{9}','{10}','{11}','{12}','{13}','{14}','{15}','{16}','{17}','{18}','{19}'".format(conf['episode']['id'],
-            conf['episode']['file_title'],
-            conf['episode']['sha']['mp3'],
-            conf['episode']['sha']['ogg'],
-            conf['episode']['size']['mp3'],
-            conf['episode']['size']['ogg'],
-            conf['episode']['length'],
-            re.sub("'", "\\'", conf['episode']['editor']),
-            re.sub("'", "\\'", conf['music']['intro']['title']),
-            re.sub("'", "\\'", conf['music']['intro']['artist']),
-            conf['music']['intro']['link'],
-            re.sub("'", "\\'", conf['music']['intro']['copyright']),
-            conf['music']['intro']['copyrightlink'],
-            re.sub("'", "\\'", conf['music']['outro']['title']),
-            re.sub("'", "\\'", conf['music']['outro']['artist']),
-            conf['music']['outro']['link'],
-            re.sub("'", "\\'", conf['music']['outro']['copyright']),
-            conf['music']['outro']['copyrightlink'],
-            conf['episode']['recorded'],
-            conf['episode']['released'])
-
-
-    conn = pymysql.connect(host = conf['mysql']['host'],
-                        port = conf['mysql']['port'],
-                        user = conf['mysql']['user'],
-                        passwd = conf['mysql']['password'],
-                        db = conf['mysql']['db'],
-                        ssl = ssl,
-                        autocommit = True)
+# Open DB connections, reused for the rest of the run. See dbConnect().
+db_conns = {}
+
+def dbConnect(conf):
+    # If [mysql]sqlite is set, a local SQLite DB stands in for the MySQL server (e.g. for testing).
+    if conf['mysql']['sqlite']:
+        key = ('sqlite', conf['mysql']['sqlite'])
+    else:
+        key = ('mysql', conf['mysql']['host'], conf['mysql']['port'], conf['mysql']['db'])
+    if key in db_conns:
+        conn = db_conns[key]
+        if key[0] == 'mysql':
+            conn.ping(reconnect = True)
+        return(conn)
+    if key[0] == 'sqlite':
+        conn = sqlite3.connect(conf['mysql']['sqlite'], isolation_level = None)
+        cols = dbCols(conf)
+        conn.execute('CREATE TABLE IF NOT EXISTS {0} ({1} PRIMARY KEY, {2})'.format(conf['mysql']['table'],
+                                                                                   cols[0],
+                                                                                   ', '.join(cols[1:])))
+    else:
+        import pymysql
+        ssl = False
+        if 'ssl' in conf['mysql']:
+            ssl = conf['mysql']['ssl']
+        conn = pymysql.connect(host = conf['mysql']['host'],
+                            port = conf['mysql']['port'],
+                            user = conf['mysql']['user'],
+                            passwd = conf['mysql']['password'],
+                            db = conf['mysql']['db'],
+                            ssl = ssl,
+                            autocommit = True)
+    db_conns[key] = conn
+    return(conn)
+
+def dbClose():
+    for key in list(db_conns.keys()):
+        db_conns.pop(key).close()
+
+# What each of the [mysql]cols is, in order (see podloader.ini.dist), so rows read back can be
+# used without caring what the columns are actually called. Other formats' columns follow.
+db_fields = ('episode', 'file_prefix', 'sha_mp3', 'sha_ogg', 'bytesize_mp3', 'bytesize_ogg', 'length', 'editor',
+             'intro_title', 'intro_artist', 'intro_link', 'intro_copyright', 'intro_copyrightlink',
+             'outro_title', 'outro_artist', 'outro_link', 'outro_copyright', 'outro_copyrightlink',
+             'recorded', 'released')
+
+def dbCols(conf):
+    # [mysql]cols plus the SHA256/size columns of any enabled formats that aren't in it already.
+    cols = conf['mysql']['cols'].split(',')
+    for mediatype in conf['formats']['enabled']:
+        cols += [c for c in output_formats[mediatype]['cols'] if c not in cols]
+    return(cols)
+
+def dbQuery(conf):
+    # An upsert on the episode ID (the first column), so re-releasing an episode updates its row.
+    cols = dbCols(conf)
+    if conf['mysql']['sqlite']:
+        marker = '?'
+        update = 'ON CONFLICT({0}) DO UPDATE SET {1}'.format(cols[0],
+                                                           ', '.join('{0} = excluded.{0}'.format(c) for c in cols[1:]))
+    else:
+        marker = '%s'
+        update = 'ON DUPLICATE KEY UPDATE {0}'.format(', '.join('{0} = VALUES({0})'.format(c) for c in cols[1:]))
+    query = 'INSERT INTO {0} ({1}) VALUES ({2}) {3}'.format(conf['mysql']['table'],
+                                                           ','.join(cols),
+                                                           ','.join([marker] * len(cols)),
+                                                           update)
+    return(query)
+
+def dbRow(conf, released = True):
+    # In the same order as dbCols(). A format that isn't enabled gets NULLs.
+    row = (conf['episode']['id'],
+           conf['episode']['file_title'],
+           conf['episode']['sha'].get('mp3'),
+           conf['episode']['sha'].get('ogg'),
+           conf['episode']['size'].get('mp3'),
+           conf['episode']['size'].get('ogg'),
+           conf['episode']['length'],
+           conf['episode']['editor'],
+           conf['music']['intro']['title'],
+           conf['music']['intro']['artist'],
+           conf['music']['intro']['link'],
+           conf['music']['intro']['copyright'],
+           conf['music']['intro']['copyrightlink'],
+           conf['music']['outro']['title'],
+           conf['music']['outro']['artist'],
+           conf['music']['outro']['link'],
+           conf['music']['outro']['copyright'],
+           conf['music']['outro']['copyrightlink'],
+           conf['episode']['recorded'],
+           (conf['episode']['released'] if released else None))
+    for mediatype in conf['formats']['enabled']:
+        if mediatype not in ('mp3', 'ogg'):
+            row += (conf['episode']['sha'][mediatype], conf['episode']['size'][mediatype])
+    return(row)
+
+def dbEpisodes(conf, conn = None):
+    # Every episode in the table, as {field: value} dicts (see db_fields), newest first.
+    cols = dbCols(conf)
+    fields = list(db_fields) + cols[len(db_fields):]
+    if not conn:
+        conn = dbConnect(conf)
     cur = conn.cursor()
-    query = 'INSERT INTO {0} ({1}) VALUES ({2})'.format(conf['mysql']['table'],
-                                                conf['mysql']['cols'],
-                                                vals)
+    cur.execute('SELECT {0} FROM {1}'.format(','.join(cols), conf['mysql']['table']))
+    rows = [dict(zip(fields, r)) for r in cur.fetchall()]
+    cur.close()
+    def order(row):
+        m = episode_re.match(row['episode'])
+        return((int(m.group(1)), int(m.group(2))) if m else (0, 0))
+    rows.sort(key = order, reverse = True)
+    return(rows)
+
+def dbEntries(confs, conn = None):
+    # Writes all the episodes in one executemany() (which pymysql sends as a single multi-row INSERT).
+    if not confs:
+        return(True)
+    conf = confs[0]
+    print('{0}: Inserting {1} episode(s) into the {2}.{3}@{4} table...'.format(datetime.datetime.now(),
+                                                                              len(confs),
+                                                                              conf['mysql']['db'],
+                                                                              conf['mysql']['table'],
+                                                                              conf['mysql']['host']))
     try:
-        cur.execute(query)
+        if not conn:
+            conn = dbConnect(conf)
+        cur = conn.cursor()
+        cur.executemany(dbQuery(conf), [dbRow(c) for c in confs])
         cur.close()
-        conn.close()
     except Exception as e:
         print('{0}: There seems to have been some error when inserting into the DB: {1}'.format(
                                                 datetime.datetime.now(), e))
+        return(False)
+    return(True)
 
-def signEp(mediatype, conf):
-    # No reason to call this for each file. Fix.
-    os.makedirs('{0}/gpg'.format(conf['local']['mediadir']), exist_ok = True)
-    sigfile = '{0}/gpg/{1}.{2}.asc'.format(conf['local']['mediadir'],
-                                            conf['episode']['file_title'],
-                                            mediatype)
+def dbEntry(conf, conn = None):
+    return(dbEntries([conf], conn = conn))
+
+def dbRetag(confs, conn = None):
+    # Only updates the SHA256/size columns of the formats in each conf's conf['episode']['media'].
+    conf = confs[0]
+    cols = dbCols(conf)
+    colnames = dict(zip(list(db_fields) + cols[len(db_fields):], cols))
+    marker = ('?' if conf['mysql']['sqlite'] else '%s')
+    print('{0}: Updating the hashes/sizes of {1} episode(s) in the {2}.{3}@{4} table...'.format(
+                                                datetime.datetime.now(),
+                                                len(confs),
+                                                conf['mysql']['db'],
+                                                conf['mysql']['table'],
+                                                conf['mysql']['host']))
+    try:
+        if not conn:
+            conn = dbConnect(conf)
+        cur = conn.cursor()
+        for c in confs:
+            for mediatype in c['episode']['media']:
+                cur.execute('UPDATE {0} SET {1} = {4}, {2} = {4} WHERE {3} = {4}'.format(
+                                                conf['mysql']['table'],
+                                                colnames['sha_' + mediatype],
+                                                colnames['bytesize_' + mediatype],
+                                                cols[0],
+                                                marker),
+                            (c['episode']['sha'][mediatype], c['episode']['size'][mediatype], c['episode']['id']))
+        cur.close()
+    except Exception as e:
+        print('{0}: There seems to have been some error when updating the DB: {1}'.format(
+                                                datetime.datetime.now(), e))
+        return(False)
+    return(True)
+
+def gpgContext(conf):
+    import gpgme
     os.environ['GNUPGHOME'] = conf['gpg']['homedir']
-    vrfykeys = []
-    sigs = {}
     gpg = gpgme.Context()
     gpg.armor = True
+    return(gpg)
+
+def gpgKeys(conf, gpg):
+    # Look up [gpg]keys once; returns {primary key fingerprint: key} of the ones that can sign.
+    keys = {}
     for k in conf['gpg']['keys']:
-        if gpg.get_key(k, True).can_sign:
+        key = gpg.get_key(k, True)
+        if key.can_sign:
             # it seems pygpgme does not allow signing with subkeys. sad day. gpg.signkeys complains if you pass it Subkey objects.
             #subkeys = []
             #for i in gpg.get_key(k, True).subkeys:
             #    subkeys.append(i.fpr)
             #indexnum = [x for x, s in enumerate(subkeys) if k in s][0]
             #vrfykeys.append(gpg.get_key(k, True).subkeys[indexnum].fpr)
-            if gpg.get_key(k, True).subkeys[0].fpr not in vrfykeys:
-                vrfykeys.append(gpg.get_key(k, True).subkeys[0].fpr)
+            if key.subkeys[0].fpr not in keys:
+                keys[key.subkeys[0].fpr] = key
+    return(keys)
+
+def signEp(mediatype, conf, gpg = None, keys = None):
+    # Every key that hasn't signed the file yet signs it in a single pass, so the file is only read once.
+    import gpgme
+    os.makedirs('{0}/gpg'.format(conf['local']['mediadir']), exist_ok = True)
+    sigfile = '{0}/gpg/{1}.{2}.asc'.format(conf['local']['mediadir'],
+                                            conf['episode']['file_title'],
+                                            mediatype)
+    sigs = {}
+    if not gpg:
+        gpg = gpgContext(conf)
+    if keys is None:
+        keys = gpgKeys(conf, gpg)
     data_in = '{0}/{1}/{2}.{3}'.format(conf['local']['mediadir'],
                                             mediatype,
                                             conf['episode']['file_title'],
                                             mediatype)
+    start = time.time()
     print('{0}: Checking for existing GPG signatures (and skipping if we signed)...'.format(datetime.datetime.now()))
     if os.path.isfile(sigfile):
         with open(sigfile, 'rb') as s:
             with open(data_in, 'rb') as f:
-                for k in gpg.verify(s, f, None):
-                    try:
-                        sigs[gpg.get_key(k.fpr, True).subkeys[0].fpr] = True
-                    except:
-                        pass
-    for k in vrfykeys:
-        if k not in sigs:
-            sigkeys = []
-            if gpg.get_key(k, True).can_sign:
-                print('{0}: Signing with key {1}...'.format(datetime.datetime.now(),
-                                                            k))
-                sigkeys.append(gpg.get_key(k, True))
-                gpg.signers = sigkeys
-                with open(sigfile, 'ab') as s:
-                    with open(data_in, 'rb') as f:
-                        gpg.sign(f, s, gpgme.SIG_MODE_DETACH)
+                for sig in gpg.verify(s, f, None):
+                    for fpr, key in keys.items():
+                        if sig.fpr in [i.fpr for i in key.subkeys]:
+                            sigs[fpr] = True
+    sigkeys = [key for fpr, key in keys.items() if fpr not in sigs]
+    if sigkeys:
+        print('{0}: Signing {1} with key(s) {2}...'.format(datetime.datetime.now(),
+                                                          data_in,
+                                                          ', '.join(k.subkeys[0].fpr for k in sigkeys)))
+        gpg.signers = sigkeys
+        with open(sigfile, 'ab') as s:
+            with open(data_in, 'rb') as f:
+                gpg.sign(f, s, gpgme.SIG_MODE_DETACH)
+    print('{0}: Signature for {1} done in {2:.2f} seconds.'.format(datetime.datetime.now(),
+                                                                  mediatype,
+                                                                  time.time() - start))
     return(sigfile)
 
-def uploadFile(conf):
-    # TODO: Can we do this via paramiko? That way we can check for the destination dir
-    # and create if it doesn't exist.
-    # Also, no reason to call this for each file.
+def signAll(conf, keys = None):
+    # Signs every format at once, each in its own thread with its own context (a gpgme context
+    # can't be shared between threads). Returns {mediatype: sigfile}.
+    if keys is None:
+        keys = gpgKeys(conf, gpgContext(conf))
+    mediatypes = conf['formats']['enabled']
+    with ThreadPoolExecutor(max_workers = len(mediatypes)) as pool:
+        jobs = {m: pool.submit(signEp, m, conf, gpg = gpgContext(conf), keys = keys) for m in mediatypes}
+        return({m: j.result() for m, j in jobs.items()})
+
+# The checksum manifest kept in each season dir; see [gpg]sums. It's in sha256sum(1)'s format,
+# so "sha256sum -c SHA256SUMS" works on it too.
+sums_file = 'SHA256SUMS'
+sums_re = re.compile('^([0-9a-f]{64}) [ *](.+)$')
+
+def seasonDir(conf):
+    return(os.path.dirname(os.path.abspath(conf['local']['mediadir'])))
+
+def sumsRead(sumsfile):
+    # Returns {path relative to the season dir: sha256}.
+    sums = {}
+    try:
+        with open(sumsfile, 'r') as f:
+            for line in f:
+                m = sums_re.match(line.rstrip('\n'))
+                if m:
+                    sums[m.group(2)] = m.group(1)
+    except FileNotFoundError:
+        pass
+    return(sums)
+
+def sumsSign(conf, sumsfile, keys = None):
+    # One detached signature over the whole manifest by every [gpg]keys key. Unlike signEp()'s, it's made
+    # from scratch every time, since the manifest changes with every release.
+    import gpgme
+    gpg = gpgContext(conf)
+    if keys is None:
+        keys = gpgKeys(conf, gpg)
+    sigfile = '{0}.asc'.format(sumsfile)
+    tmpfile = '{0}.{1}'.format(sigfile, os.getpid())
+    print('{0}: Signing {1} with key(s) {2}...'.format(datetime.datetime.now(), sumsfile, ', '.join(keys)))
+    gpg.signers = list(keys.values())
+    with open(sumsfile, 'rb') as f, open(tmpfile, 'wb') as s:
+        gpg.sign(f, s, gpgme.SIG_MODE_DETACH)
+    os.replace(tmpfile, sigfile)
+    return(sigfile)
+
+def sumsUpdate(confs, keys = None):
+    # Puts the hashes the hash stage already has for the episodes in their seasons' SHA256SUMS, in place
+    # of any older files of the same episode and format, and (with [gpg]enabled) signs each manifest that
+    # changed once, however many episodes went into it.
+    # Returns {season dir: [the manifest, its signature]}.
+    seasons = {}
+    for conf in confs:
+        seasons.setdefault(seasonDir(conf), []).append(conf)
+    files = {}
+    for seasondir, sconfs in seasons.items():
+        sumsfile = os.path.join(seasondir, sums_file)
+        files[seasondir] = [sumsfile]
+        # Watch mode (and several podloader runs) can release episodes of the same season at once.
+        with open(os.path.join(seasondir, '.{0}.lock'.format(sums_file)), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            sums = sumsRead(sumsfile)
+            new = dict(sums)
+            for conf in sconfs:
+                for mediatype, mediafile in conf['episode']['media'].items():
+                    # Whatever was there before (e.g. under the old file name, if the title changed) is gone.
+                    formatdir = os.path.relpath(os.path.dirname(mediafile), seasondir) + '/'
+                    new = {r: sha for r, sha in new.items() if not r.startswith(formatdir)}
+                    new[os.path.relpath(mediafile, seasondir)] = conf['episode']['sha'][mediatype]
+            changed = new != sums or not os.path.isfile(sumsfile)
+            if changed:
+                tmpfile = '{0}.{1}'.format(sumsfile, os.getpid())
+                with open(tmpfile, 'w') as f:
+                    for relpath in sorted(new):
+                        f.write('{0}  {1}\n'.format(new[relpath], relpath))
+                os.replace(tmpfile, sumsfile)
+                print('{0}: Updated {1} ({2} file(s)).'.format(datetime.datetime.now(), sumsfile, len(new)))
+            if sconfs[0]['gpg']['enabled']:
+                if changed or not os.path.isfile('{0}.asc'.format(sumsfile)):
+                    sumsSign(sconfs[0], sumsfile, keys = keys)
+                files[seasondir].append('{0}.asc'.format(sumsfile))
+    return(files)
+
+# The name of the manifest the sftp/local upload methods keep in each remote season dir.
+upload_manifest = '.podloader.manifest.json'
+
+class localTransport(object):
+    # [rsync]method = local; "uploads" to a local directory. Mostly useful for testing.
+    def __init__(self, conf, root):
+        self.root = root
+
+    def path(self, relpath):
+        return(os.path.join(self.root, relpath))
+
+    def size(self, relpath):
+        try:
+            return(os.path.getsize(self.path(relpath)))
+        except FileNotFoundError:
+            return(None)
+
+    def read(self, relpath):
+        try:
+            with open(self.path(relpath), 'rb') as f:
+                return(f.read())
+        except FileNotFoundError:
+            return(None)
+
+    def open(self, relpath, mode):
+        os.makedirs(os.path.dirname(self.path(relpath)), exist_ok = True)
+        return(open(self.path(relpath), mode))
+
+    def rename(self, src, dst):
+        os.replace(self.path(src), self.path(dst))
+
+    def reset(self):
+        pass
+
+    @classmethod
+    def closeAll(cls):
+        pass
+
+class sftpTransport(localTransport):
+    # [rsync]method = sftp; one SSH connection per upload thread, since paramiko's SFTP client isn't thread-safe.
+    # They're kept for the thread's later files, and closed by closeAll() once uploadManifest() is done.
+    local = threading.local()
+    clients = []
+    lock = threading.Lock()
+
+    def __init__(self, conf, root):
+        import paramiko
+        self.root = root
+        if not getattr(self.local, 'sftp', None):
+            ssh = paramiko.SSHClient()
+            ssh.load_system_host_keys()
+            with self.lock:
+                self.clients.append(ssh)
+            ssh.connect(conf['rsync']['host'],
+                        port = conf['rsync']['port'],
+                        username = conf['rsync']['user'])
+            self.local.ssh = ssh
+            self.local.sftp = ssh.open_sftp()
+        self.sftp = self.local.sftp
+
+    def path(self, relpath):
+        return('/'.join((self.root, relpath)))
+
+    def size(self, relpath):
+        try:
+            return(self.sftp.stat(self.path(relpath)).st_size)
+        except IOError:
+            return(None)
+
+    def read(self, relpath):
+        try:
+            with self.sftp.open(self.path(relpath), 'rb') as f:
+                return(f.read())
+        except IOError:
+            return(None)
+
+    def open(self, relpath, mode):
+        # Make any missing parent dirs first.
+        parts = self.path(relpath).split('/')[:-1]
+        for i in range(2, len(parts) + 1):
+            try:
+                self.sftp.mkdir('/'.join(parts[:i]))
+            except IOError:
+                pass
+        return(self.sftp.open(self.path(relpath), mode))
+
+    def rename(self, src, dst):
+        self.sftp.posix_rename(self.path(src), self.path(dst))
+
+    def reset(self):
+        # Drop this thread's connection (e.g. after a failed transfer) so the next one reconnects.
+        try:
+            self.sftp.close()
+            self.local.ssh.close()
+        except Exception:
+            pass
+        with self.lock:
+            if self.local.ssh in self.clients:
+                self.clients.remove(self.local.ssh)
+        self.local.sftp = None
+
+    @classmethod
+    def closeAll(cls):
+        # The upload threads are gone by now, so their thread-locals can't be reached; close every connection
+        # made through the list instead, and forget this thread's so the next upload reconnects.
+        with cls.lock:
+            for ssh in cls.clients:
+                try:
+                    ssh.close()
+                except Exception:
+                    pass
+            cls.clients.clear()
+        cls.local.sftp = None
+
+upload_transports = {'local': localTransport,
+                     'sftp': sftpTransport}
+
+def sendFile(conf, root, relpath, localfile, sha):
+    # Uploads to <relpath>.<sha>.part and renames it into place once it's complete. If a try (or a
+    # previous run) failed, the next one picks up from however much of the .part made it to the server.
+    # Returns relpath, or None if it couldn't be uploaded. (It runs in a thread, so it can't exit().)
+    transport = None
+    partpath = '{0}.{1}.part'.format(relpath, sha[:16])
+    localsize = os.path.getsize(localfile)
+    start = time.time()
+    sent = 0
+    for attempt in range(conf['rsync']['retries'] + 1):
+        try:
+            if not transport:
+                transport = upload_transports[conf['rsync']['method']](conf, root)
+            offset = transport.size(partpath) or 0
+            if offset > localsize:
+                offset = 0
+            with open(localfile, 'rb') as f, transport.open(partpath, ('ab' if offset else 'wb')) as r:
+                f.seek(offset)
+                for chunk in iter(lambda: f.read(hash_bufsize), b''):
+                    r.write(chunk)
+                    sent += len(chunk)
+            if transport.size(partpath) != localsize:
+                raise IOError('{0} is incomplete on the server'.format(partpath))
+            transport.rename(partpath, relpath)
+            break
+        except Exception as e:
+            # Anything from the connection (paramiko has its own exceptions) on; the next try reconnects.
+            if transport:
+                transport.reset()
+                transport = None
+            if attempt == conf['rsync']['retries']:
+                print('{0}: ERROR: Could not upload {1}: {2}'.format(datetime.datetime.now(), localfile, e))
+                return(None)
+            print('{0}: Upload of {1} failed ({2}); retrying...'.format(datetime.datetime.now(), relpath, e))
+            time.sleep(2 ** attempt)
+    elapsed = time.time() - start
+    print('{0}: Uploaded {1} ({2} bytes in {3:.2f} seconds, {4:.0f} bytes/sec).'.format(datetime.datetime.now(),
+                                                                                     relpath,
+                                                                                     sent,
+                                                                                     elapsed,
+                                                                                     sent / max(elapsed, 0.001)))
+    return(relpath)
+
+def uploadManifest(conf, mediadirs, known = None):
+    # Only sends the files whose SHA256/size differ from the season's remote manifest, several at once.
+    # known is {local file: (sha256, size)} from the hash stage, so the media files aren't hashed again;
+    # only the rest (the signatures and SHA256SUMS, which are small) are.
+    # Returns whether they all made it; the ones that did are in the manifest either way.
+    root = '{0}S{1}'.format(conf['rsync']['path'], conf['episode']['season'])
+    transport = upload_transports[conf['rsync']['method']](conf, root)
+    manifest = transport.read(upload_manifest)
+    manifest = (json.loads(manifest.decode('utf-8')) if manifest else {})
+    localfiles = {}
+    for mediadir in mediadirs:
+        parent = os.path.dirname(os.path.abspath(mediadir))
+        if os.path.isfile(mediadir):
+            # e.g. the season's SHA256SUMS.
+            localfiles[os.path.relpath(mediadir, parent)] = mediadir
+            continue
+        for dirpath, dirs, files in os.walk(mediadir):
+            for f in files:
+                localfile = os.path.join(dirpath, f)
+                localfiles[os.path.relpath(localfile, parent)] = localfile
+    known = known or {}
+    hashes = {r: (known[f][0], int(known[f][1])) for r, f in localfiles.items()
+                if f in known and int(known[f][1]) == os.path.getsize(f)}
+    # A different size means it's changed without needing to hash it first.
+    tohash = {r: f for r, f in localfiles.items()
+                if r not in hashes and r in manifest and manifest[r][1] == os.path.getsize(f)}
+    hashes.update(hashAll(tohash) if tohash else {})
+    changed = {}
+    for relpath, localfile in localfiles.items():
+        if relpath in hashes and list(hashes[relpath]) == manifest.get(relpath):
+            continue
+        changed[relpath] = localfile
+    print('{0}: {1} of {2} file(s) need uploading...'.format(datetime.datetime.now(),
+                                                            len(changed),
+                                                            len(localfiles)))
+    tohash = {r: f for r, f in changed.items() if r not in hashes}
+    hashes.update(hashAll(tohash) if tohash else {})
+    with ThreadPoolExecutor(max_workers = conf['rsync']['streams']) as pool:
+        sent = [job.result() for job in [pool.submit(sendFile, conf, root, r, f, hashes[r][0])
+                                         for r, f in changed.items()]]
+    for relpath in sent:
+        if relpath:
+            manifest[relpath] = list(hashes[relpath])
+    with transport.open(upload_manifest + '.part', 'wb') as f:
+        f.write(json.dumps(manifest, indent = 1, sort_keys = True).encode('utf-8'))
+    transport.rename(upload_manifest + '.part', upload_manifest)
+    return(all(sent))
+
+def mediaHashes(confs):
+    # {media file: (sha256, size)} from the hash stage, for uploadFile().
+    return({mediafile: (c['episode']['sha'][mediatype], c['episode']['size'][mediatype])
+            for c in confs for mediatype, mediafile in c['episode'].get('media', {}).items()
+            if mediatype in c['episode'].get('sha', {}) and mediatype in c['episode'].get('size', {})})
+
+def uploadFile(conf, mediadirs = None, known = None):
+    # In batch mode, mediadirs is every episode dir of the season so they all go in one upload.
+    # It can have files in the season dir too (the SHA256SUMS), which go in the remote season dir.
+    # known is passed on to uploadManifest() (see mediaHashes()).
+    if not mediadirs:
+        mediadirs = [conf['local']['mediadir']]
     print('{0}: Syncing files to server...'.format(datetime.datetime.now()))
-    subprocess.run(['rsync',
+    if conf['rsync']['method'] in upload_transports:
+        try:
+            return(uploadManifest(conf, mediadirs, known = known))
+        except Exception as e:
+            print('{0}: ERROR: Could not sync to the server: {1}'.format(datetime.datetime.now(), e))
+            return(False)
+        finally:
+            upload_transports[conf['rsync']['method']].closeAll()
+    ret = subprocess.run(['rsync',
                     '-a',
-                    '--info=progress2',
-                    '{0}'.format(conf['local']['mediadir']),
-                    '{0}@{1}:{2}S{3}/.'.format(conf['rsync']['user'],
+                    '--info=progress2'] +
+                    mediadirs +
+                    ['{0}@{1}:{2}S{3}/.'.format(conf['rsync']['user'],
                                                 conf['rsync']['host'],
                                                 conf['rsync']['path'],
-                                                conf['episode']['season'])])
+                                                conf['episode']['season'])]).returncode
+    logExit('rsync', ret)
+    if ret != 0:
+        print('{0}: rsync exited with status {1}.'.format(datetime.datetime.now(), ret))
+    return(ret == 0)
+
+# The XML namespaces for the [feed]feeds flavors, which add the iTunes or Google Play tags.
+feed_ns = {'itunes': 'http://www.itunes.com/dtds/podcast-1.0.dtd',
+           'google': 'http://www.google.com/schemas/play-podcasts/1.0'}
+
+def feedItem(conf, feed, row, title):
+    # Renders one <item>. See feedGen() for how these are cached.
+    from xml.sax.saxutils import escape, quoteattr
+    m = episode_re.match(row['episode'])
+    season, serial = m.group(1), m.group(2)
+    released = row['released']
+    if not isinstance(released, datetime.datetime):
+        released = datetime.datetime.strptime(str(released).split('.')[0], '%Y-%m-%d %H:%M:%S')
+    credits = ('Edited by {0}. Intro: "{1}" by {2} (<a href="{3}">link</a>, <a href="{4}">{5}</a>). '
+               'Outro: "{6}" by {7} (<a href="{8}">link</a>, <a href="{9}">{10}</a>).').format(
+                                                row['editor'],
+                                                row['intro_title'], row['intro_artist'], row['intro_link'],
+                                                row['intro_copyrightlink'], row['intro_copyright'],
+                                                row['outro_title'], row['outro_artist'], row['outro_link'],
+                                                row['outro_copyrightlink'], row['outro_copyright'])
+    enclosure = '{0}S{1}/E{2}/{3}/{4}.{3}'.format(conf['feed']['media_url'], season, serial,
+                                                  feed['format'], row['file_prefix'])
+    link = tmplRender(conf['templates']['url'], {'SEASONEPISODE': row['episode'],
+                                                 'SEASON': season,
+                                                 'EPISODE': serial})
+    xml = ['<item>',
+           '<title>{0}</title>'.format(escape('{0}: {1}'.format(row['episode'], title))),
+           '<link>{0}</link>'.format(escape(link)),
+           '<guid isPermaLink="false">{0}</guid>'.format(row['sha_' + feed['format']]),
+           '<enclosure url={0} length="{1}" type={2}/>'.format(quoteattr(enclosure),
+                                                               row['bytesize_' + feed['format']],
+                                                               quoteattr(output_formats[feed['format']]['mime'])),
+           '<pubDate>{0}</pubDate>'.format(email.utils.format_datetime(released.replace(tzinfo = datetime.timezone.utc))),
+           '<description>{0}</description>'.format(escape(credits))]
+    if feed['flavor'] == 'itunes':
+        xml += ['<itunes:title>{0}</itunes:title>'.format(escape(title)),
+                '<itunes:duration>{0}</itunes:duration>'.format(row['length']),
+                '<itunes:season>{0}</itunes:season>'.format(int(season)),
+                '<itunes:episode>{0}</itunes:episode>'.format(int(serial)),
+                '<itunes:summary>{0}</itunes:summary>'.format(escape(credits))]
+    elif feed['flavor'] == 'google':
+        xml += ['<googleplay:description>{0}</googleplay:description>'.format(escape(credits))]
+    xml.append('</item>')
+    return('\n'.join(xml))
+
+def feedChannel(conf, feed):
+    # Everything in the feed up to the first <item>, and what closes it after the last one.
+    from xml.sax.saxutils import escape
+    fc = conf['feed']
+    ns = ''
+    if feed['flavor']:
+        ns = ' xmlns:{0}="{1}"'.format(('googleplay' if feed['flavor'] == 'google' else feed['flavor']),
+                                       feed_ns[feed['flavor']])
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+           '<rss version="2.0"{0}>'.format(ns),
+           '<channel>',
+           '<title>{0}</title>'.format(escape(fc['title'])),
+           '<link>{0}</link>'.format(escape(fc['link'])),
+           '<description>{0}</description>'.format(escape(fc['description'])),
+           '<language>{0}</language>'.format(escape(fc['language'])),
+           '<copyright>{0}</copyright>'.format(escape(conf['tags']['copyright'])),
+           '<lastBuildDate>{0}</lastBuildDate>'.format(email.utils.format_datetime(
+                                                    datetime.datetime.now(datetime.timezone.utc))),
+           '<image><url>{0}</url><title>{1}</title><link>{2}</link></image>'.format(escape(fc['image']),
+                                                                                   escape(fc['title']),
+                                                                                   escape(fc['link']))]
+    if feed['flavor'] == 'itunes':
+        xml += ['<itunes:author>{0}</itunes:author>'.format(escape(conf['tags']['artist'])),
+                '<itunes:image href="{0}"/>'.format(escape(fc['image'])),
+                '<itunes:category text="{0}"/>'.format(escape(fc['category'])),
+                '<itunes:explicit>{0}</itunes:explicit>'.format(escape(fc['explicit']))]
+    elif feed['flavor'] == 'google':
+        xml += ['<googleplay:author>{0}</googleplay:author>'.format(escape(conf['tags']['artist'])),
+                '<googleplay:image href="{0}"/>'.format(escape(fc['image'])),
+                '<googleplay:category text="{0}"/>'.format(escape(fc['category'])),
+                '<googleplay:explicit>{0}</googleplay:explicit>'.format(escape(fc['explicit']))]
+    return('\n'.join(xml), '</channel>\n</rss>\n')
+
+def feedTitle(row):
+    # The DB doesn't have the title, so for an episode we've never rendered, make one from file_prefix.
+    title = re.sub('^{0}\\.'.format(row['episode'].lower()), '', row['file_prefix'])
+    return(title.replace('.', ' ').strip().title())
+
+def feedGen(conf, titles = None):
+    # Writes [feed]feeds from the episode table. Each rendered <item> is cached under [cache]path/feed/
+    # keyed on its DB row and the feed settings, so adding an episode only renders the new one.
+    # titles is {episode ID: title} for the episodes in this run; any others keep the title they were
+    # last rendered with (or get one from feedTitle()). Returns the list of feed files.
+    # Nothing uploads them; [feed]path has to be (or be synced to) wherever the feeds are served from.
+    titles = titles or {}
+    rows = dbEpisodes(conf)
+    outfiles = []
+    os.makedirs(conf['feed']['path'], exist_ok = True)
+    for feed in conf['feed']['feeds']:
+        start = time.time()
+        cachedir = '{0}/feed/{1}'.format(conf['cache']['path'], feed['file'])
+        os.makedirs(cachedir, exist_ok = True)
+        head, tail = feedChannel(conf, feed)
+        items = []
+        rendered = 0
+        for row in rows:
+            if not row.get('sha_' + feed['format']):
+                continue  # Released before this format was enabled.
+            if not episode_re.match(row['episode']):
+                continue  # Not one of ours (feedItem() needs the season/episode).
+            cachefile = '{0}/{1}.json'.format(cachedir, row['episode'])
+            try:
+                with open(cachefile, 'r') as f:
+                    cached = json.load(f)
+            except (FileNotFoundError, ValueError):
+                cached = {}
+            title = titles.get(row['episode']) or cached.get('title') or feedTitle(row)
+            key = hashlib.sha256(json.dumps([row, title, feed, conf['feed']['media_url'],
+                                             conf['templates']['url']],
+                                            sort_keys = True, default = str).encode('utf-8')).hexdigest()
+            if cached.get('key') != key:
+                cached = {'key': key, 'title': title, 'xml': feedItem(conf, feed, row, title)}
+                with open(cachefile, 'w') as f:
+                    json.dump(cached, f)
+                rendered += 1
+            items.append(cached['xml'])
+        outfile = '{0}/{1}'.format(conf['feed']['path'], feed['file'])
+        tmpfile = '{0}.{1}'.format(outfile, os.getpid())
+        with open(tmpfile, 'w', encoding = 'utf-8') as f:
+            f.write('\n'.join([head] + items + [tail]))
+        os.replace(tmpfile, outfile)
+        outfiles.append(outfile)
+        print('{0}: Wrote {1} ({2} item(s), {3} re-rendered) in {4:.2f} seconds.'.format(datetime.datetime.now(),
+                                                                                       outfile,
+                                                                                       len(items),
+                                                                                       rendered,
+                                                                                       time.time() - start))
+    return(outfiles)
+
+# The release pipeline, in order. Each episode has a checkpoint (under [cache]path/checkpoint/)
+# recording what every finished stage was run with and what it produced, so a re-run
+# resumes from the first stage that isn't still valid instead of starting over.
+stages = ('analyze', 'transcode', 'tag', 'hash', 'db', 'sign', 'upload', 'feed')
+
+def fileState(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return(None)
+    return([st.st_size, st.st_mtime])
+
+def ckptFile(conf):
+    return('{0}/checkpoint/{1}.json'.format(conf['cache']['path'], conf['episode']['id']))
+
+def ckptLoad(conf, force = False):
+    # With force, none of the stages count as done (see stageValid()), but the ones that aren't re-run
+    # keep their records; e.g. -D/--distribute re-runs the DB stage onwards after the workers' encode.
+    ckpt = {'stages': {}, 'files': {}}
+    try:
+        with open(ckptFile(conf), 'r') as f:
+            ckpt = json.load(f)
+    except (FileNotFoundError, ValueError):
+        pass
+    ckpt['force'] = force
+    return(ckpt)
+
+def ckptSave(conf, ckpt):
+    cachefile = ckptFile(conf)
+    os.makedirs(os.path.dirname(cachefile), exist_ok = True)
+    tmpfile = '{0}.{1}'.format(cachefile, os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump({k: v for k, v in ckpt.items() if k != 'force'}, f, indent = 1)
+    os.replace(tmpfile, cachefile)
+
+def stageInputs(conf, stage):
+    # What each stage's result depends on, besides the stage before it.
+    if stage == 'analyze':
+        return([conf['episode']['raw'], fileState(conf['episode']['raw']), conf['loudness']])
+    if stage == 'transcode':
+        return([conf['episode']['raw'], fileState(conf['episode']['raw']),
+                {m: output_formats[m]['args'] for m in conf['formats']['enabled']},
+                conf['local']['mediadir'], conf['episode']['file_title']])
+    if stage == 'tag':
+        return([conf['tags'], conf['episode']['pretty_title'], conf['episode']['month'],
+                conf['episode']['day'], fileState(conf['tags']['img'])])
+    if stage == 'db':
+        # Everything but the release timestamp, which is different every run.
+        return([dbRow(conf, released = False), conf['mysql']['sqlite'], conf['mysql']['host'],
+                conf['mysql']['db'], conf['mysql']['table'], dbCols(conf)])
+    if stage == 'sign':
+        return([conf['gpg']['enabled'], conf['gpg']['keys'], conf['gpg']['sums'], conf['gpg']['per_file']])
+    if stage == 'upload':
+        files = (sorted(conf['episode']['media'].values()) + conf['episode'].get('sigs', []) +
+                 conf['episode'].get('sums', []))
+        return([conf['rsync'], [(f, fileState(f)) for f in files]])
+    if stage == 'feed':
+        return([conf['feed'], dbRow(conf, released = False), conf['episode']['title']])
+    return([])
+
+def stageFP(conf, ckpt, stage):
+    # Chained to the previous stage's fingerprint, so a change upstream invalidates everything after it.
+    idx = stages.index(stage)
+    prev = ''
+    if idx > 0:
+        prev = ckpt['stages'].get(stages[idx - 1], {}).get('fp', '')
+    fp = json.dumps([prev, stageInputs(conf, stage)], sort_keys = True, default = str)
+    return(hashlib.sha256(fp.encode('utf-8')).hexdigest())
+
+def stageValid(conf, ckpt, stage):
+    # If it's still valid, whatever the stage left in conf['episode'] is restored too.
+    done = ckpt['stages'].get(stage)
+    if ckpt.get('force') or not done or done['fp'] != stageFP(conf, ckpt, stage):
+        return(False)
+    for f in done['outputs']:
+        if fileState(f) is None or ckpt['files'].get(f) != fileState(f):
+            return(False)
+    conf['episode'].update(copy.deepcopy(done['data']))
+    print('{0}: Skipping the {1} stage; it is already done for {2}.'.format(datetime.datetime.now(),
+                                                                          stage,
+                                                                          conf['episode']['id']))
+    return(True)
+
+def stageDone(conf, ckpt, stage, outputs = (), data = None):
+    ckpt['stages'][stage] = {'fp': stageFP(conf, ckpt, stage),
+                             'outputs': list(outputs),
+                             'data': data or {}}
+    for f in outputs:
+        ckpt['files'][f] = fileState(f)
+    # Since this stage just (re-)ran, anything after it has to run again too.
+    for later in stages[stages.index(stage) + 1:]:
+        ckpt['stages'].pop(later, None)
+    ckptSave(conf, ckpt)
+
+def stageAnalyze(conf):
+    conf['episode']['afilter'] = None
+    if conf['loudness']['enabled']:
+        analysis = analyze(conf)
+        conf['episode']['afilter'] = analysis['afilter']
+        conf['episode']['length'] = str(int(analysis['end'] - analysis['start']))
+    return((), {'afilter': conf['episode']['afilter'],
+                'length': conf['episode']['length'],
+                'flacsha': conf['episode'].get('flacsha')})
+
+def stageTranscode(conf):
+    conf['episode']['media'] = transcodeAll(conf)
+    return(conf['episode']['media'].values(), {'media': conf['episode']['media']})
+
+def stageTag(conf):
+    # All the formats at once; the cover art is converted first so they can share it.
+    coverArt(conf)
+    with ThreadPoolExecutor(max_workers = len(conf['episode']['media'])) as pool:
+        for job in [pool.submit(output_formats[m]['tagger'], conf, f) for m, f in conf['episode']['media'].items()]:
+            job.result()
+    return(conf['episode']['media'].values(), None)
+
+def stageHash(conf):
+    for mediatype, (sha, size) in hashAll(conf['episode']['media']).items():
+        conf['episode']['sha'][mediatype] = sha
+        conf['episode']['size'][mediatype] = size
+    return(conf['episode']['media'].values(), {'sha': conf['episode']['sha'],
+                                               'size': conf['episode']['size']})
+
+def stageDB(conf):
+    if not dbEntry(conf):
+        return(None)
+    return((), None)
+
+def stageSign(conf):
+    conf['episode']['sigs'] = []
+    conf['episode']['sums'] = []
+    if conf['gpg']['enabled'] and conf['gpg']['per_file']:
+        conf['episode']['sigs'] = sorted(signAll(conf).values())
+    if conf['gpg']['sums']:
+        conf['episode']['sums'] = sumsUpdate([conf])[seasonDir(conf)]
+    # The SHA256SUMS isn't an output; it changes whenever another episode of the season is released.
+    return(conf['episode']['sigs'], {'sigs': conf['episode']['sigs'], 'sums': conf['episode']['sums']})
+
+def stageUpload(conf):
+    if not uploadFile(conf, mediadirs = [conf['local']['mediadir']] + conf['episode'].get('sums', []),
+                      known = mediaHashes([conf])):
+        return(None)
+    return((), None)
+
+def stageFeed(conf):
+    if not conf['feed']['enabled']:
+        return((), None)
+    return(feedGen(conf, titles = {conf['episode']['id']: conf['episode']['title']}), None)
+
+stage_funcs = {'analyze': stageAnalyze,
+               'transcode': stageTranscode,
+               'tag': stageTag,
+               'hash': stageHash,
+               'db': stageDB,
+               'sign': stageSign,
+               'upload': stageUpload,
+               'feed': stageFeed}
+
+def runStages(conf, names = stages, force = False):
+    # Runs the given stages (in pipeline order) for an episode, skipping those that are still valid.
+    # A stage function returns (outputs, data), or None if it failed; a failed stage isn't
+    # checkpointed, so the next run picks up from there. Nothing after a failed stage is run, since
+    # it would be working from a missing result. Returns conf, or None if a stage failed.
+    ckpt = ckptLoad(conf, force = force)
+    for stage in stages:
+        if stage not in names or stageValid(conf, ckpt, stage):
+            continue
+        with instrument(conf, stage) as rec:
+            result = stage_funcs[stage](conf)
+            rec['ok'] = result is not None
+        if result is None:
+            print('{0}: The {1} stage failed for {2}; re-run to resume from there.'.format(datetime.datetime.now(),
+                                                                                          stage,
+                                                                                          conf['episode']['id']))
+            return(None)
+        outputs, data = result
+        stageDone(conf, ckpt, stage, outputs = outputs, data = data)
+    return(conf)
+
+def modeArgs(parser):
+    # The options that pick what a run does. argParse() and batchArgParse() both need them.
+    parser.add_argument('-F',
+                        '--force',
+                        dest = 'force',
+                        default = False,
+                        action = 'store_true',
+                        help = "Ignore this episode's checkpoint and run every stage again (cached transcodes are still reused).")
+    parser.add_argument('-c',
+                        '--check',
+                        dest = 'check',
+                        default = False,
+                        action = 'store_true',
+                        help = "Only check the config, the tools/modules it needs and the input files (for every episode in batch mode), then exit.")
+    parser.add_argument('-w',
+                        '--watch',
+                        dest = 'watch',
+                        default = False,
+                        action = 'store_true',
+                        help = ("Run as a daemon that releases each episode as soon as its final FLAC (sXeY.edited.flac, "
+                                "sXeY.final.flac or sXeY.flac) shows up under [local]path next to a sXeY.json sidecar "
+                                "(with the same fields as a -b/--batch manifest entry). See [watch]."))
+    parser.add_argument('-D',
+                        '--distribute',
+                        dest = 'distribute',
+                        default = False,
+                        action = 'store_true',
+                        help = ("Don't encode here; put each format of the episode(s) in the [distributed]queue for "
+                                "-W/--worker processes (on this or other machines) to encode, tag and hash, then "
+                                "do the DB, signing and upload here."))
+    parser.add_argument('-W',
+                        '--worker',
+                        dest = 'worker',
+                        default = False,
+                        action = 'store_true',
+                        help = "Run [distributed]workers encode workers for the [distributed]queue. See -D/--distribute.")
+    parser.add_argument('-R',
+                        '--retag',
+                        dest = 'retag',
+                        default = False,
+                        action = 'store_true',
+                        help = ("Re-apply the current [tags] and cover art to every episode in the DB without re-encoding, "
+                                "then update the hashes, sizes, signatures and uploads of only the files that changed."))
+    parser.add_argument('-b',
+                        '--batch',
+                        dest = 'manifest',
+                        default = False,
+                        metavar = 'MANIFEST',
+                        help = ("Release many episodes in one run from a CSV or JSON manifest instead of the arguments above. "
+                                "The fields are named after the long options (e.g. title, season, episode, raw_recording, "
+                                "intro_artist, ..., outro_copyrightlink, editor, file, now)."))
+    return(parser)
 
 def argParse():
     parser = argparse.ArgumentParser(
@@ -595,6 +1987,7 @@ def argParse():
                         default = False,
                         action = 'store_true',
                         help = "Instead of getting the date based on the time of the file, use today's date (for media tags).")
+    modeArgs(parser)
     try:
         args = parser.parse_args()
         print('{0}: Starting.'.format(datetime.datetime.now()))
@@ -603,20 +1996,725 @@ def argParse():
         exit(1)
     return(args)
 
+def batchArgParse():
+    # Only used to spot -b/--batch (or the other modes) before argParse() insists on the single-episode arguments.
+    parser = modeArgs(argparse.ArgumentParser(add_help = False))
+    args, _ = parser.parse_known_args()
+    return(args)
+
+def manifestParse(manifest):
+    # Returns a list of argparse.Namespaces, one per episode, as if argParse() had been called for each.
+    manifest = os.path.abspath(os.path.expanduser(manifest))
+    if not os.path.isfile(manifest):
+        exit('ERROR: The manifest you specified does not seem to exist ({0}).'.format(manifest))
+    with open(manifest, 'r', newline = '') as f:
+        if manifest.lower().endswith('.json'):
+            entries = json.load(f)
+        else:
+            entries = list(csv.DictReader(f))
+    return([manifestEntry(entry, 'Entry {0} in the manifest'.format(idx))
+            for idx, entry in enumerate(entries, start = 1)])
+
+def manifestEntry(entry, name):
+    # One manifest entry (or watch-mode sidecar) to an argparse.Namespace. name is for the error message.
+    entry = {k.strip().replace('-', '_'):v for k, v in entry.items() if v not in (None, '')}
+    if 'file' in entry:
+        entry['flacfile'] = entry.pop('file')
+    for req in ('title', 'season', 'episode', 'raw_recording',
+                'intro_artist', 'intro_title', 'intro_link', 'intro_copyright',
+                'outro_artist', 'outro_title', 'outro_link', 'outro_copyright'):
+        if req not in entry:
+            exit('ERROR: {0} is missing the "{1}" field.'.format(name, req))
+    args = argparse.Namespace(intro_copyrightlink = False,
+                              outro_copyrightlink = False,
+                              editor = None,
+                              flacfile = False,
+                              now = False)
+    for k, v in entry.items():
+        setattr(args, k, v)
+    args.season = int(args.season)
+    args.episode = int(args.episode)
+    if not isinstance(args.now, bool):
+        args.now = str(args.now).lower() in ('1', 'yes', 'true')
+    return(args)
+
+def checkConf(conf):
+    # For --check: everything we can verify without encoding, connecting or signing anything.
+    # (confArgs() has already checked the FLAC and the raw recording.) Returns a list of problems.
+    problems = []
+    def need(module, why):
+        if not importlib.util.find_spec(module):
+            problems.append('the {0} module is needed for {1} but is not installed'.format(module, why))
+    if not shutil.which('ffmpeg'):
+        problems.append('ffmpeg is not installed (or not in $PATH)')
+    need('mutagen', 'tagging')
+    need('PIL', 'the cover art')
+    if not os.path.isfile(conf['tags']['img']):
+        problems.append('[tags]img ({0}) does not exist'.format(conf['tags']['img']))
+    if conf['mysql']['sqlite']:
+        if not os.path.isdir(os.path.dirname(os.path.abspath(conf['mysql']['sqlite']))):
+            problems.append('the directory for [mysql]sqlite ({0}) does not exist'.format(conf['mysql']['sqlite']))
+    else:
+        need('pymysql', 'the DB')
+    if conf['gpg']['enabled']:
+        need('gpgme', 'signing')
+        if conf['gpg']['homedir'] and not os.path.isdir(conf['gpg']['homedir']):
+            problems.append('[gpg]homedir ({0}) does not exist'.format(conf['gpg']['homedir']))
+        if not [k for k in conf['gpg']['keys'] if k]:
+            problems.append('[gpg]enabled is set but no [gpg]keys are')
+    if conf['rsync']['method'] == 'rsync' and not shutil.which('rsync'):
+        problems.append('rsync is not installed (or not in $PATH)')
+    if conf['rsync']['method'] == 'sftp':
+        need('paramiko', 'the sftp upload method')
+    return(problems)
+
+def checkMain(confs, skipped = 0):
+    # Prints what --check found for each episode and exits non-zero if anything (or any episode) is wrong.
+    failed = skipped
+    for conf in confs:
+        problems = checkConf(conf)
+        for p in problems:
+            print('{0}: {1}: {2}.'.format(datetime.datetime.now(), conf['episode']['id'], p))
+        if problems:
+            failed += 1
+        else:
+            print('{0}: {1}: OK ({2}, {3} seconds).'.format(datetime.datetime.now(),
+                                                            conf['episode']['id'],
+                                                            conf['episode']['raw'],
+                                                            conf['episode']['length']))
+    if failed:
+        exit('ERROR: {0} of {1} episode(s) failed the check.'.format(failed, len(confs) + skipped))
+
+def encodeEp(conf, force = False):
+    # Everything that can be done for an episode without touching the DB, GPG or server.
+    return(runStages(conf, names = ('analyze', 'transcode', 'tag', 'hash'), force = force))
+
+def batchMain(manifest, check = False, distribute = False, force = False):
+    # One config parse, one DB connection, one GPG key lookup and one rsync per season for the whole manifest.
+    start = time.time()
+    baseconf = configParse(readonly = check)
+    confs = []
+    entries = manifestParse(manifest)
+    for args in entries:
+        try:
+            confs.append(confArgs(copy.deepcopy(baseconf), args, readonly = check))
+        except SystemExit as e:
+            print('{0}: Skipping S{1}E{2}: {3}'.format(datetime.datetime.now(), args.season, args.episode, e))
+    if check:
+        checkMain(confs, skipped = len(entries) - len(confs))
+        return()
+    encoded = []
+    if distribute and confs:
+        encoded = distEncode(confs, force = force)
+    else:
+        print('{0}: Encoding {1} episode(s) with {2} worker(s)...'.format(datetime.datetime.now(),
+                                                                         len(confs),
+                                                                         baseconf['batch']['workers']))
+        with ProcessPoolExecutor(max_workers = baseconf['batch']['workers']) as pool:
+            jobs = {pool.submit(encodeEp, c, force = force): c for c in confs}
+            for job in as_completed(jobs):
+                try:
+                    conf = job.result()
+                    if conf:
+                        encoded.append(conf)
+                except (Exception, SystemExit) as e:
+                    print('{0}: Failed to encode {1}: {2}'.format(datetime.datetime.now(),
+                                                                  jobs[job]['episode']['id'],
+                                                                  e))
+    if not encoded:
+        exit('ERROR: No episodes were encoded successfully.')
+    encoded.sort(key = lambda c: (int(c['episode']['season']), int(c['episode']['serial'])))
+    ckpts = {c['episode']['id']: ckptLoad(c, force = force) for c in encoded}
+    # Like runStages(), an episode goes no further than its first failed stage; `ready` is whichever
+    # episodes are still going.
+    ready = encoded
+    todo = [c for c in ready if not stageValid(c, ckpts[c['episode']['id']], 'db')]
+    with instrument(baseconf, 'db'):
+        if dbEntries(todo, conn = dbConnect(baseconf)):
+            for conf in todo:
+                stageDone(conf, ckpts[conf['episode']['id']], 'db')
+        else:
+            print('{0}: The db stage failed for {1}; re-run to resume from there.'.format(
+                                                datetime.datetime.now(),
+                                                ', '.join(c['episode']['id'] for c in todo)))
+            ready = [c for c in ready if c not in todo]
+    keys = None
+    signed = []
+    for conf in ready:
+        if stageValid(conf, ckpts[conf['episode']['id']], 'sign'):
+            continue
+        conf['episode']['sigs'] = []
+        if conf['gpg']['enabled'] and conf['gpg']['per_file']:
+            with instrument(conf, 'sign'):
+                if keys is None:
+                    keys = gpgKeys(baseconf, gpgContext(baseconf))
+                conf['episode']['sigs'] = sorted(signAll(conf, keys = keys).values())
+        signed.append(conf)
+    # Each season's SHA256SUMS is only updated (and signed) once, for all of its episodes.
+    sums = {}
+    if signed and baseconf['gpg']['sums']:
+        with instrument(baseconf, 'sign'):
+            if keys is None and baseconf['gpg']['enabled']:
+                keys = gpgKeys(baseconf, gpgContext(baseconf))
+            sums = sumsUpdate(signed, keys = keys)
+    for conf in signed:
+        conf['episode']['sums'] = sums.get(seasonDir(conf), [])
+        stageDone(conf, ckpts[conf['episode']['id']], 'sign', outputs = conf['episode']['sigs'],
+                  data = {'sigs': conf['episode']['sigs'], 'sums': conf['episode']['sums']})
+    seasons = {}
+    uploaded = True
+    for conf in ready:
+        if not stageValid(conf, ckpts[conf['episode']['id']], 'upload'):
+            seasons.setdefault(conf['episode']['season'], []).append(conf)
+    for season, sconfs in seasons.items():
+        sumsfiles = sorted(set(f for c in sconfs for f in c['episode'].get('sums', [])))
+        with instrument(baseconf, 'upload'):
+            if uploadFile(sconfs[0], mediadirs = [c['local']['mediadir'] for c in sconfs] + sumsfiles,
+                          known = mediaHashes(sconfs)):
+                for conf in sconfs:
+                    stageDone(conf, ckpts[conf['episode']['id']], 'upload')
+            else:
+                print('{0}: The upload stage failed for {1}; re-run to resume from there.'.format(
+                                                datetime.datetime.now(),
+                                                ', '.join(c['episode']['id'] for c in sconfs)))
+                ready = [c for c in ready if c not in sconfs]
+                uploaded = False
+    # The feeds only need writing once, however many episodes there are.
+    todo = [c for c in ready if not stageValid(c, ckpts[c['episode']['id']], 'feed')]
+    if todo and not uploaded:
+        # They're made from the whole table, so they'd list the episodes that are in the DB but didn't
+        # make it to the server.
+        print('{0}: Not writing the feeds until every upload has succeeded.'.format(datetime.datetime.now()))
+        ready = [c for c in ready if c not in todo]
+        todo = []
+    if todo and baseconf['feed']['enabled']:
+        with instrument(baseconf, 'feed'):
+            outfiles = feedGen(todo[0], titles = {c['episode']['id']: c['episode']['title'] for c in ready})
+    for conf in todo:
+        stageDone(conf, ckpts[conf['episode']['id']], 'feed',
+                  outputs = (outfiles if baseconf['feed']['enabled'] else ()))
+    elapsed = time.time() - start
+    dbClose()
+    if baseconf['log']['summary']:
+        runSummary(baseconf)
+    print('{0}: Finished {1} of {2} episode(s) in {3:.2f} seconds ({4:.2f} episodes/minute).'.format(
+                                                datetime.datetime.now(),
+                                                len(ready),
+                                                len(confs),
+                                                elapsed,
+                                                len(ready) / (elapsed / 60)))
+
+# Finished masters, as confArgs() looks for them: sXeY.edited.flac, sXeY.final.flac or sXeY.flac.
+master_re = re.compile('^s([0-9]+)e([0-9]+)(\\.edited|\\.final)?\\.flac$', flags = re.I)
+
+class pollWatcher(object):
+    # The fallback for watchMain() if inotify_simple isn't installed (or inotify isn't available):
+    # a walk of the tree every [watch]interval seconds.
+    def __init__(self, root):
+        self.root = root
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return(None)  # i.e. "anything might have changed"
+
+class inotifyWatcher(object):
+    # Watches root and every dir under it (including ones made later) for files being written/moved in.
+    def __init__(self, root):
+        import inotify_simple
+        self.flags = inotify_simple.flags
+        self.inotify = inotify_simple.INotify()
+        self.mask = (self.flags.CLOSE_WRITE | self.flags.MOVED_TO | self.flags.MODIFY |
+                     self.flags.CREATE | self.flags.DELETE_SELF)
+        self.dirs = {}
+        for dirpath, dirs, files in os.walk(root):
+            self.add(dirpath)
+
+    def add(self, path):
+        try:
+            self.dirs[self.inotify.add_watch(path, self.mask)] = path
+        except OSError:
+            pass
+
+    def wait(self, timeout):
+        # Returns the set of paths that changed.
+        changed = set()
+        for event in self.inotify.read(timeout = int(timeout * 1000)):
+            parent = self.dirs.get(event.wd)
+            if not parent or not event.name:
+                continue
+            path = os.path.join(parent, event.name)
+            if event.mask & self.flags.ISDIR:
+                if event.mask & (self.flags.CREATE | self.flags.MOVED_TO):
+                    self.add(path)
+                    changed.add(path)
+                continue
+            changed.add(path)
+        return(changed)
+
+def watchScan(root, paths = None):
+    # {master FLAC: fileState} under root, or of just the given (changed) paths. A changed
+    # sidecar counts as a change to the FLAC(s) next to it.
+    found = {}
+    if paths is None:
+        paths = []
+        for dirpath, dirs, files in os.walk(root):
+            paths += [os.path.join(dirpath, f) for f in files]
+    for path in paths:
+        if os.path.isdir(path):
+            found.update(watchScan(path))
+            continue
+        dirpath, name = os.path.split(path)
+        if name.lower().endswith('.json'):
+            m = master_re.match(re.sub('(\\.flac)?\\.json$', '.flac', name, flags = re.I))
+            if m:
+                for flac in os.listdir(dirpath) if os.path.isdir(dirpath) else []:
+                    if master_re.match(flac) and master_re.match(flac).group(1, 2) == m.group(1, 2):
+                        found[os.path.join(dirpath, flac)] = fileState(os.path.join(dirpath, flac))
+            continue
+        if master_re.match(name):
+            found[path] = fileState(path)
+    return({f: st for f, st in found.items() if st is not None})
+
+def watchSidecar(flac):
+    # The episode's metadata, from <flac>.json or sXeY.json next to it; None if there isn't one (yet).
+    # It has the same fields as a batch manifest entry; season, episode and file default to the FLAC's.
+    m = master_re.match(os.path.basename(flac))
+    for sidecar in ('{0}.json'.format(flac),
+                    '{0}/s{1}e{2}.json'.format(os.path.dirname(flac), m.group(1), m.group(2))):
+        try:
+            with open(sidecar, 'r') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            continue
+        except ValueError:
+            return(None)  # Probably still being written.
+        meta.setdefault('season', int(m.group(1)))
+        meta.setdefault('episode', int(m.group(2)))
+        meta.setdefault('file', flac)
+        if 'raw_recording' in meta:
+            meta['raw_recording'] = os.path.join(os.path.dirname(flac), os.path.expanduser(meta['raw_recording']))
+        return(meta)
+    return(None)
+
+def watchQueue(conf):
+    # The persistent job queue, so nothing that was found is lost if the daemon is restarted.
+    os.makedirs(conf['cache']['path'], exist_ok = True)
+    queue = sqlite3.connect('{0}/watch.db'.format(conf['cache']['path']), isolation_level = None)
+    queue.execute('CREATE TABLE IF NOT EXISTS jobs (episode TEXT PRIMARY KEY, flac TEXT, state TEXT, '
+                  'flacstate TEXT, meta TEXT, added TEXT, updated TEXT, error TEXT)')
+    # Anything that was running when we last stopped starts over (the checkpoints make that cheap).
+    queue.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running'")
+    return(queue)
+
+def watchRelease(meta):
+    # Runs in a worker process, so an exit() for one episode doesn't take the daemon down.
+    try:
+        conf = confArgs(configParse(), manifestEntry(meta, meta['file']))
+        ok = runStages(conf)
+        dbClose()
+    except SystemExit as e:
+        return(str(e) or 'exited')
+    if not ok:
+        return('a stage failed; see the log')
+    return(None)
+
+def watchMain():
+    # Watches [local]path for finished masters and releases each one once it's stopped changing
+    # for [watch]settle seconds and has a sidecar, up to [watch]workers at a time.
+    conf = configParse()
+    root = conf['local']['path']
+    queue = watchQueue(conf)
+    try:
+        watcher = inotifyWatcher(root)
+        print('{0}: Watching {1} (inotify)...'.format(datetime.datetime.now(), root))
+    except (ImportError, OSError):
+        watcher = pollWatcher(root)
+        print('{0}: Watching {1} (polling every {2} seconds)...'.format(datetime.datetime.now(),
+                                                                        root,
+                                                                        conf['watch']['interval']))
+    pending = {}  # {flac: [fileState, when it last changed]}
+    running = {}
+    changed = None  # i.e. scan everything at startup
+    def finish(job, epid):
+        # Records how a finished release went; one that raised counts as failed, like one that exit()ed.
+        try:
+            error = job.result()
+        except Exception as e:
+            error = str(e)
+        print('{0}: {1} {2}.'.format(datetime.datetime.now(), epid,
+                                     ('failed: {0}'.format(error) if error else 'is released')))
+        queue.execute('UPDATE jobs SET state = ?, updated = ?, error = ? WHERE episode = ?',
+                      (('failed' if error else 'done'), str(datetime.datetime.now()), error, epid))
+    with ProcessPoolExecutor(max_workers = conf['watch']['workers']) as pool:
+        try:
+            while True:
+                now = time.time()
+                for flac, st in watchScan(root, changed).items():
+                    if flac not in pending or pending[flac][0] != st:
+                        pending[flac] = [st, now]
+                for flac, (st, since) in list(pending.items()):
+                    if fileState(flac) != st:
+                        pending.pop(flac)
+                        if fileState(flac) is not None:
+                            pending[flac] = [fileState(flac), now]
+                        continue
+                    if now - since < conf['watch']['settle']:
+                        continue
+                    meta = watchSidecar(flac)
+                    if not meta:
+                        continue
+                    pending.pop(flac)
+                    epid = 'S{0}E{1}'.format(meta['season'], meta['episode'])
+                    row = queue.execute('SELECT flacstate, meta, state FROM jobs WHERE episode = ?', (epid,)).fetchone()
+                    if row and row[0] == json.dumps(st) and row[1] == json.dumps(meta, sort_keys = True):
+                        continue
+                    print('{0}: Queueing {1} ({2}).'.format(datetime.datetime.now(), epid, flac))
+                    queue.execute('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, NULL) ON CONFLICT(episode) DO UPDATE SET '
+                                  'flac = excluded.flac, state = excluded.state, flacstate = excluded.flacstate, '
+                                  'meta = excluded.meta, updated = excluded.updated, error = NULL',
+                                  (epid, flac, 'queued', json.dumps(st), json.dumps(meta, sort_keys = True),
+                                   str(datetime.datetime.now()), str(datetime.datetime.now())))
+                for job in [j for j in running if j.done()]:
+                    finish(job, running.pop(job))
+                while len(running) < conf['watch']['workers']:
+                    row = queue.execute("SELECT episode, meta FROM jobs WHERE state = 'queued' "
+                                        "AND episode NOT IN ({0}) ORDER BY updated LIMIT 1".format(
+                                                ','.join('?' * len(running))), tuple(running.values())).fetchone()
+                    if not row:
+                        break
+                    print('{0}: Releasing {1}...'.format(datetime.datetime.now(), row[0]))
+                    queue.execute("UPDATE jobs SET state = 'running', updated = ? WHERE episode = ?",
+                                  (str(datetime.datetime.now()), row[0]))
+                    running[pool.submit(watchRelease, json.loads(row[1]))] = row[0]
+                # Wake up sooner if something's settling or running.
+                timeout = conf['watch']['interval']
+                if pending or running:
+                    timeout = min(timeout, 1)
+                changed = watcher.wait(timeout)
+                if changed is not None:
+                    changed = changed | set(pending)
+        except KeyboardInterrupt:
+            print('{0}: Stopping; waiting for {1} running release(s)...'.format(datetime.datetime.now(), len(running)))
+            for job, epid in running.items():
+                finish(job, epid)
+
+def jobQueue(conf):
+    # The shared (episode x format) job queue for the coordinator (--distribute) and its workers (--worker).
+    # It's an SQLite file, so every node needs to see it (and [local]mediadir) at the same path.
+    os.makedirs(os.path.dirname(conf['distributed']['queue']), exist_ok = True)
+    queue = sqlite3.connect(conf['distributed']['queue'], timeout = 60, isolation_level = None)
+    queue.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, run TEXT, episode TEXT, '
+                  'format TEXT, conf TEXT, state TEXT, worker TEXT, heartbeat REAL, sha TEXT, size INTEGER, '
+                  'path TEXT, error TEXT)')
+    return(queue)
+
+def jobClaim(queue, worker, stale):
+    # Atomically takes the oldest queued job, or one whose worker stopped sending heartbeats.
+    queue.execute('BEGIN IMMEDIATE')
+    try:
+        job = queue.execute("SELECT id, format, conf FROM jobs WHERE state = 'queued' OR "
+                            "(state = 'claimed' AND heartbeat < ?) ORDER BY id LIMIT 1",
+                            (time.time() - stale,)).fetchone()
+        if job:
+            queue.execute("UPDATE jobs SET state = 'claimed', worker = ?, heartbeat = ? WHERE id = ?",
+                          (worker, time.time(), job[0]))
+    finally:
+        queue.execute('COMMIT')
+    return(job)
+
+def jobRun(conf, mediatype):
+    # A worker's half of encodeEp(), for one format. Returns (mediafile, sha256, size).
+    conf['formats']['enabled'] = [mediatype]
+    with instrument(conf, 'transcode'):
+        mediafile = transcodeAll(conf)[mediatype]
+    with instrument(conf, 'tag'):
+        output_formats[mediatype]['tagger'](conf, mediafile)
+    with instrument(conf, 'hash'):
+        sha, size = getHash(mediafile)
+    return(mediafile, sha, size)
+
+def workerLoop(idx):
+    # One worker process for --worker; claims and runs jobs until it's been idle for [distributed]idle seconds.
+    conf = configParse()
+    dc = conf['distributed']
+    queue = jobQueue(conf)
+    worker = '{0}:{1}'.format(platform.node(), os.getpid())
+    idle_since = time.time()
+    while True:
+        job = jobClaim(queue, worker, dc['stale'])
+        if not job:
+            if dc['idle'] and time.time() - idle_since > dc['idle']:
+                return()
+            time.sleep(dc['interval'])
+            continue
+        jobid, mediatype, jobconf = job
+        jobconf = json.loads(jobconf)
+        print('{0}: [{1}] Encoding {2} ({3})...'.format(datetime.datetime.now(), worker,
+                                                       jobconf['episode']['id'], mediatype))
+        running = threading.Event()
+        def heartbeat():
+            hb = jobQueue(conf)
+            while not running.wait(dc['stale'] / 3):
+                hb.execute('UPDATE jobs SET heartbeat = ? WHERE id = ?', (time.time(), jobid))
+            hb.close()
+        beat = threading.Thread(target = heartbeat, daemon = True)
+        beat.start()
+        try:
+            mediafile, sha, size = jobRun(jobconf, mediatype)
+            queue.execute("UPDATE jobs SET state = 'done', sha = ?, size = ?, path = ?, error = NULL WHERE id = ?",
+                          (sha, size, mediafile, jobid))
+        except (Exception, SystemExit) as e:
+            print('{0}: [{1}] {2} ({3}) failed: {4}'.format(datetime.datetime.now(), worker,
+                                                           jobconf['episode']['id'], mediatype, e))
+            queue.execute("UPDATE jobs SET state = 'failed', error = ? WHERE id = ?", (str(e), jobid))
+        finally:
+            running.set()
+            beat.join()
+        idle_since = time.time()
+
+def workerMain():
+    conf = configParse()
+    print('{0}: Starting {1} worker(s) on {2}...'.format(datetime.datetime.now(),
+                                                        conf['distributed']['workers'],
+                                                        conf['distributed']['queue']))
+    with ProcessPoolExecutor(max_workers = conf['distributed']['workers']) as pool:
+        for job in [pool.submit(workerLoop, i) for i in range(conf['distributed']['workers'])]:
+            job.result()
+
+def distEncode(confs, force = False):
+    # The coordinator's version of encodeEp() for a list of episodes: the analysis is done here, then every
+    # format of every episode goes in the job queue for the workers. Returns the confs that were encoded.
+    # Episodes whose transcode/tag/hash stages are still valid aren't sent out again.
+    baseconf = confs[0]
+    queue = jobQueue(baseconf)
+    queued = {}
+    failed = set()
+    for conf in confs:
+        if not runStages(conf, names = ('analyze',), force = force):
+            failed.add(conf['episode']['id'])
+            continue
+        ckpt = ckptLoad(conf, force = force)
+        if all(stageValid(conf, ckpt, s) for s in ('transcode', 'tag', 'hash')):
+            continue
+        queued[conf['episode']['id']] = conf
+        for mediatype in conf['formats']['enabled']:
+            queue.execute("INSERT INTO jobs (run, episode, format, conf, state) VALUES (?, ?, ?, ?, 'queued')",
+                          (run_id, conf['episode']['id'], mediatype, json.dumps(conf)))
+    print('{0}: Queued {1} job(s) for {2} episode(s) in {3}; waiting for workers...'.format(
+                                                datetime.datetime.now(),
+                                                sum(len(c['formats']['enabled']) for c in queued.values()),
+                                                len(queued),
+                                                baseconf['distributed']['queue']))
+    last = None
+    # A job finishing or a worker's heartbeat counts as progress; without any for [distributed]timeout
+    # seconds (e.g. no workers are running), whatever's left is given up on.
+    timeout = baseconf['distributed']['timeout']
+    progress = (None, None)
+    progressed = time.time()
+    while True:
+        jobs = queue.execute('SELECT episode, format, state, sha, size, path, error, worker FROM jobs '
+                             'WHERE run = ?', (run_id,)).fetchall()
+        left = len([j for j in jobs if j[2] in ('queued', 'claimed')])
+        if left != last:
+            print('{0}: {1} of {2} job(s) left.'.format(datetime.datetime.now(), left, len(jobs)))
+            last = left
+        if not left:
+            break
+        beat = queue.execute('SELECT MAX(heartbeat) FROM jobs WHERE run = ?', (run_id,)).fetchone()[0]
+        if (left, beat) != progress:
+            progress = (left, beat)
+            progressed = time.time()
+        elif timeout and time.time() - progressed > timeout:
+            print('{0}: No progress from the workers in {1:.0f} seconds; giving up on {2} job(s).'.format(
+                                                datetime.datetime.now(), timeout, left))
+            queue.execute("UPDATE jobs SET state = 'failed', error = 'timed out' WHERE run = ? AND "
+                          "state IN ('queued', 'claimed')", (run_id,))
+            continue
+        time.sleep(baseconf['distributed']['interval'])
+    for epid, mediatype, state, sha, size, path, error, worker in jobs:
+        if state != 'done':
+            print('{0}: {1} ({2}) failed on {3}: {4}'.format(datetime.datetime.now(), epid, mediatype, worker, error))
+            failed.add(epid)
+            continue
+        conf = queued[epid]
+        conf['episode'].setdefault('media', {})[mediatype] = path
+        conf['episode']['sha'][mediatype] = sha
+        conf['episode']['size'][mediatype] = size
+    queue.execute('DELETE FROM jobs WHERE run = ?', (run_id,))
+    queue.close()
+    for epid, conf in queued.items():
+        if epid in failed:
+            continue
+        ckpt = ckptLoad(conf)
+        media = conf['episode']['media']
+        stageDone(conf, ckpt, 'transcode', outputs = media.values(), data = {'media': media})
+        stageDone(conf, ckpt, 'tag', outputs = media.values())
+        stageDone(conf, ckpt, 'hash', outputs = media.values(), data = {'sha': conf['episode']['sha'],
+                                                                        'size': conf['episode']['size']})
+    return([c for c in confs if c['episode']['id'] not in failed])
+
+def retagConf(baseconf, row):
+    # What confArgs() would have made for an episode, from its DB row. The title and date aren't in the DB;
+    # retagFile() takes them from the file's current tags (these are only the fallbacks).
+    conf = copy.deepcopy(baseconf)
+    m = episode_re.match(row['episode'])
+    conf['episode'] = {'id': row['episode'],
+                       'season': m.group(1),
+                       'serial': m.group(2),
+                       'file_title': row['file_prefix'],
+                       'pretty_title': '{0}: {1}'.format(row['episode'], feedTitle(row)),
+                       'released': str(row['released']),
+                       'media': {},
+                       'sha': {},
+                       'size': {}}
+    if conf['tags']['track'] == 'EPISODE':
+        conf['tags']['track'] = conf['episode']['serial']
+    conf['tags']['url'] = tmplRender(conf['templates']['url'], {'SEASONEPISODE': conf['episode']['id'],
+                                                                'SEASON': conf['episode']['season'],
+                                                                'EPISODE': conf['episode']['serial']})
+    if conf['tags']['album'] == 'SEASON':
+        conf['tags']['album'] = 'Season {0}'.format(conf['episode']['season'])
+    conf['local']['mediadir'] = '{0}/S{1}/E{2}'.format(conf['local']['mediadir'],
+                                                    conf['episode']['season'],
+                                                    conf['episode']['serial'])
+    return(conf)
+
+def retagFile(conf, mediatype, mediafile):
+    # Runs in a worker. Returns (sha256, size) if the file was written, or None if its tags were already right.
+    import mutagen
+    old = mutagen.File(mediafile, easy = True)
+    released = conf['episode']['released'].split(' ')[0].split('-')
+    date = re.split('[.-]', str((old.get('date') or [''])[0]))
+    if len(date) != 3:
+        date = released
+    conf['episode']['pretty_title'] = (old.get('title') or [conf['episode']['pretty_title']])[0]
+    conf['episode']['month'], conf['episode']['day'] = date[1], date[2]
+    if not conf['tags']['year']:
+        conf['tags']['year'] = date[0]
+    conf['tags']['year'] = str(conf['tags']['year'])
+    if not output_formats[mediatype]['tagger'](conf, mediafile):
+        return(None)
+    return(getHash(mediafile))
+
+def retagMain():
+    # -R/--retag: applies the current [tags] (and cover art) to every released file in the DB, in
+    # [batch]workers processes, without re-encoding anything. Only the files whose bytes changed get
+    # their hashes and sizes updated in the DB, signed again (and put in the SHA256SUMS) and uploaded.
+    start = time.time()
+    baseconf = configParse()
+    # retagConf() needs the season/episode; any other rows aren't ours to retag.
+    rows = {r['episode']: r for r in dbEpisodes(baseconf) if episode_re.match(r['episode'])}
+    # Convert the cover art before forking so the workers all get it from the in-memory cache.
+    coverArt(baseconf)
+    confs = {}
+    jobs = []
+    for epid, row in rows.items():
+        conf = retagConf(baseconf, row)
+        confs[epid] = conf
+        for mediatype in conf['formats']['enabled']:
+            mediafile = '{0}/{1}/{2}.{1}'.format(conf['local']['mediadir'], mediatype, row['file_prefix'])
+            if row.get('sha_' + mediatype) and os.path.isfile(mediafile):
+                jobs.append((conf, mediatype, mediafile))
+    print('{0}: Retagging {1} file(s) of {2} episode(s) with {3} worker(s)...'.format(datetime.datetime.now(),
+                                                                                     len(jobs),
+                                                                                     len(rows),
+                                                                                     baseconf['batch']['workers']))
+    changed = {}
+    with instrument(baseconf, 'tag'):
+        with ProcessPoolExecutor(max_workers = baseconf['batch']['workers']) as pool:
+            futures = {pool.submit(retagFile, *j): j for j in jobs}
+            for job in as_completed(futures):
+                conf, mediatype, mediafile = futures[job]
+                try:
+                    result = job.result()
+                except (Exception, SystemExit) as e:
+                    print('{0}: Failed to retag {1}: {2}'.format(datetime.datetime.now(), mediafile, e))
+                    continue
+                if not result or result[0] == rows[conf['episode']['id']]['sha_' + mediatype]:
+                    continue
+                conf = confs[conf['episode']['id']]
+                conf['episode']['media'][mediatype] = mediafile
+                conf['episode']['sha'][mediatype], conf['episode']['size'][mediatype] = result
+                changed[conf['episode']['id']] = conf
+    todo = sorted(changed.values(), key = lambda c: (int(c['episode']['season']), int(c['episode']['serial'])))
+    print('{0}: {1} file(s) of {2} episode(s) changed.'.format(datetime.datetime.now(),
+                                                              sum(len(c['episode']['media']) for c in todo),
+                                                              len(todo)))
+    if todo:
+        with instrument(baseconf, 'db'):
+            if not dbRetag(todo):
+                # The files changed but the DB didn't; signing/uploading them now would publish hashes
+                # that don't match it. (A re-run won't see them as changed, since their tags are right now.)
+                exit('ERROR: Could not update the DB, so the hashes/sizes of {0} are out of date; '
+                     'not signing or uploading them.'.format(', '.join(c['episode']['id'] for c in todo)))
+        keys = None
+        sums = {}
+        with instrument(baseconf, 'sign'):
+            if baseconf['gpg']['enabled']:
+                keys = gpgKeys(baseconf, gpgContext(baseconf))
+            if baseconf['gpg']['enabled'] and baseconf['gpg']['per_file']:
+                with ThreadPoolExecutor(max_workers = max(len(baseconf['formats']['enabled']), 1)) as pool:
+                    signjobs = []
+                    for conf in todo:
+                        for mediatype in conf['episode']['media']:
+                            # The old signature is for the old bytes; signEp() would only append to it.
+                            sigfile = '{0}/gpg/{1}.{2}.asc'.format(conf['local']['mediadir'],
+                                                                    conf['episode']['file_title'],
+                                                                    mediatype)
+                            if os.path.isfile(sigfile):
+                                os.remove(sigfile)
+                            signjobs.append(pool.submit(signEp, mediatype, conf, gpg = gpgContext(conf), keys = keys))
+                    for job in signjobs:
+                        job.result()
+            if baseconf['gpg']['sums']:
+                sums = sumsUpdate(todo, keys = keys)
+        seasons = {}
+        for conf in todo:
+            seasons.setdefault(conf['episode']['season'], []).append(conf)
+        for season, sconfs in seasons.items():
+            with instrument(baseconf, 'upload'):
+                uploadFile(sconfs[0], mediadirs = ([c['local']['mediadir'] for c in sconfs] +
+                                                   sums.get(seasonDir(sconfs[0]), [])),
+                           known = mediaHashes(sconfs))
+        if baseconf['feed']['enabled']:
+            with instrument(baseconf, 'feed'):
+                feedGen(baseconf)
+    dbClose()
+    if baseconf['log']['summary']:
+        runSummary(baseconf)
+    print('{0}: Finished retagging in {1:.2f} seconds.'.format(datetime.datetime.now(), time.time() - start))
+
 def main():
-    conf = confArgs(configParse(), argParse())
-    mp3 = transcodeMP3(conf)
-    tagMP3(conf, mp3)
-    ogg = transcodeOGG(conf)
-    tagOGG(conf, ogg)
-    conf['episode']['sha']['mp3'] = getSHA256(mp3)
-    conf['episode']['sha']['ogg'] = getSHA256(ogg)
-    conf['episode']['size']['mp3'] = getSize(mp3)
-    conf['episode']['size']['ogg'] = getSize(ogg)
-    dbEntry(conf)
-    signEp('mp3', conf)
-    signEp('ogg', conf)
-    uploadFile(conf)
+    os.environ['PODLOADER_RUN_ID'] = run_id
+    batch = batchArgParse()
+    if batch.retag:
+        retagMain()
+        return()
+    if batch.worker:
+        workerMain()
+        return()
+    if batch.watch:
+        watchMain()
+        return()
+    if batch.manifest:
+        batchMain(batch.manifest, check = batch.check, distribute = batch.distribute, force = batch.force)
+        return()
+    args = argParse()
+    conf = confArgs(configParse(readonly = args.check), args, readonly = args.check)
+    if args.check:
+        checkMain([conf])
+        return()
+    if args.distribute:
+        if not distEncode([conf], force = args.force):
+            exit('ERROR: The workers could not encode {0}.'.format(conf['episode']['id']))
+        ok = runStages(conf, names = stages[stages.index('db'):], force = args.force)
+    else:
+        ok = runStages(conf, force = args.force)
+    dbClose()
+    if conf['log']['summary']:
+        runSummary(conf)
+    if not ok:
+        exit('ERROR: {0} did not finish; re-run to resume.'.format(conf['episode']['id']))
     print('{0}: Finished.'.format(datetime.datetime.now()))
 
 if __name__ == '__main__':
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 
 # stdlib
+import argparse
+import hashlib
+import json
 import os
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 # pypi
 import gpg
 import gpg.constants
@@ -19,11 +24,21 @@ GPGKEY = '0x63D1CEA387C27A92E0D50AB8343C305F9109D4DC'
 # to the media file(s)).
 # If you need to change this, check the signer class.
 EPPATH = '~/podcast/releases'
-FILEEXTS = ('mp3', 'ogg')
+# Every format podloader can release (its output_formats/[formats]enabled).
+FILEEXTS = ('mp3', 'ogg', 'opus', 'm4a')
+# The extension of the detached sigs.
+SIGEXT = '.asc'
+# Where to remember which files were already verified (and their size/mtime and
+# their sig's mtime at the time), so unchanged files aren't verified again.
+STATEFILE = '~/.cache/podloader/re_sign.json'
+# How many files to verify at once. Each worker gets its own GPG context.
+WORKERS = os.cpu_count()
+# The per-season checksum manifest podloader keeps (see [gpg]sums); it's signed as SUMSFILE + SIGEXT.
+SUMSFILE = 'SHA256SUMS'
 
 class signer(object):
     def __init__(self, key_id, gpg_home = '~/.gnupg',
-                 sig_ext = '.asc', gpg_armor = True):
+                 sig_ext = SIGEXT, gpg_armor = True):
         os.environ['GNUPGHOME'] = os.path.abspath(os.path.expanduser(gpg_home))
         self.sig_ext = sig_ext
         self.gpg = gpg.Context()
@@ -34,26 +49,54 @@ class signer(object):
             self.gpg.signers.append(self.key)
         self.gpg.armor = True
 
+    def sigPath(self, sigpath_base):
+        return('.'.join((sigpath_base, re.sub(r'^\.', '', self.sig_ext))))
+
     def chkSigValid(self, fpath, sigpath_base):
-        sigpath = '.'.join((sigpath_base, re.sub('^\.', '', self.sig_ext)))
-        with open(sigpath, 'rb') as sig, open(fpath, 'rb') as f, \
-                                         open(os.devnull, 'wb') as DEVNULL:
-            try:
+        sigpath = self.sigPath(sigpath_base)
+        try:
+            with open(sigpath, 'rb') as sig, open(fpath, 'rb') as f, \
+                                             open(os.devnull, 'wb') as DEVNULL:
                 self.gpg.verify(f, signature = sig, sink = DEVNULL,
                                 verify = self.gpg.signers)
                 return(True)
-            except (gpg.errors.BadSignatures, gpg.errors.GPGMEError,
-                    FileNotFoundError):
-                print('BAD/MISSING SIGNATURE: {0}'.format(fpath))
-                return(False)
+        except (gpg.errors.BadSignatures, gpg.errors.GPGMEError,
+                FileNotFoundError):
+            print('BAD/MISSING SIGNATURE: {0}'.format(fpath))
+            return(False)
 
     def signEpFile(self, fpath, sigpath_base):
-        sigpath = '.'.join((sigpath_base, re.sub('^\.', '', self.sig_ext)))
+        sigpath = self.sigPath(sigpath_base)
         with open(sigpath, 'wb') as f, open(fpath, 'rb') as s:
             f.write(self.gpg.sign(s, mode = gpg.constants.SIG_MODE_DETACH)[0])
         print('Signed/re-signed {0}'.format(fpath))
         return()
 
+def getSums(sumsfile):
+    # Returns {path relative to the season dir: sha256} from a sha256sum-style file.
+    sums = {}
+    with open(sumsfile, 'r') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if len(line) > 66 and line[65] in ' *':
+                sums[line[66:]] = line[:64]
+    return(sums)
+
+def putSums(sumsfile, sums):
+    tmpfile = '{0}.{1}'.format(sumsfile, os.getpid())
+    with open(tmpfile, 'w') as f:
+        for relpath in sorted(sums):
+            f.write('{0}  {1}\n'.format(sums[relpath], relpath))
+    os.replace(tmpfile, sumsfile)
+
+def hashFile(fpath):
+    # Runs in a worker. Returns (fpath, sha256).
+    filehash = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            filehash.update(chunk)
+    return(fpath, filehash.hexdigest())
+
 def getEpFiles(path, exts):
     print('Building list of media files; please wait...')
     fpaths = []
@@ -64,20 +107,186 @@ def getEpFiles(path, exts):
                 fpaths.append(os.path.join(root, f))
     return(fpaths)
 
+def getSigBase(fpath):
+    sigfilebase = os.path.abspath(
+                    os.path.join(
+                        os.path.dirname(fpath),
+                        os.path.join('..',
+                                     'gpg',
+                                     os.path.basename(fpath))))
+    return(sigfilebase)
+
+def getFileState(fpath, sigpath):
+    # (size, mtime, sig mtime); if any of these change, the file needs verifying again.
+    st = os.stat(fpath)
+    try:
+        sigmtime = os.stat(sigpath).st_mtime
+    except FileNotFoundError:
+        sigmtime = None
+    return([st.st_size, st.st_mtime, sigmtime])
+
+def loadState(statefile):
+    try:
+        with open(statefile, 'r') as f:
+            return(json.load(f))
+    except (FileNotFoundError, ValueError):
+        return({})
+
+def saveState(statefile, state):
+    os.makedirs(os.path.dirname(statefile), exist_ok = True)
+    tmpfile = '{0}.{1}'.format(statefile, os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmpfile, statefile)
+
+# The per-process signer, set up once per worker by initWorker().
+worker_signer = None
+
+def initWorker(GPGHOME, KEYID):
+    global worker_signer
+    worker_signer = signer(KEYID, gpg_home = GPGHOME)
+
+def procFile(fpath, dryrun = False):
+    # Runs in a worker. Returns (fpath, whether the sig was valid, state after any re-signing).
+    sigfilebase = getSigBase(fpath)
+    sigpath = worker_signer.sigPath(sigfilebase)
+    valid = worker_signer.chkSigValid(fpath, sigfilebase)
+    if not valid and not dryrun:
+        worker_signer.signEpFile(fpath, sigfilebase)
+    return(fpath, valid, getFileState(fpath, sigpath))
+
+def parseArgs():
+    args = argparse.ArgumentParser(description = 'Re-sign all episode files that have an invalid signature.',
+                                   epilog = 'https://git.square-r00t.net/Podloader')
+    args.add_argument('-n',
+                      '--dry-run',
+                      dest = 'dryrun',
+                      action = 'store_true',
+                      help = 'If specified, only report which files would be re-signed.')
+    args.add_argument('-j',
+                      '--jobs',
+                      dest = 'workers',
+                      type = int,
+                      default = WORKERS,
+                      help = 'How many files to verify at once. The default is the number of CPUs ({0}).'.format(WORKERS))
+    args.add_argument('-s',
+                      '--state',
+                      dest = 'statefile',
+                      default = STATEFILE,
+                      help = 'Where to keep the verification state. The default is {0}.'.format(STATEFILE))
+    args.add_argument('-m',
+                      '--manifest',
+                      dest = 'manifest',
+                      action = 'store_true',
+                      help = ('If specified, verify each season\'s signed {0} once and then only compare the '
+                              'files\' hashes against it, instead of verifying every file\'s own signature. '
+                              'A bad manifest signature (or a file that changed or is missing from it) '
+                              'means the manifest is updated and re-signed.').format(SUMSFILE))
+    args.add_argument('-f',
+                      '--force',
+                      dest = 'force',
+                      action = 'store_true',
+                      help = 'If specified, verify every file even if it has not changed since it was last verified.')
+    return(args)
+
+def sumsMain(args, GPGHOME, KEYID, fpaths, state):
+    # The --manifest mode: one signature verification per season instead of one per file.
+    # The hashes are cached in the state file (by size and mtime) like the verifications are.
+    hashstate = state.setdefault(SUMSFILE, {})
+    seasons = {}
+    for f in fpaths:
+        seasondir = os.path.dirname(os.path.dirname(os.path.dirname(f)))
+        seasons.setdefault(seasondir, []).append(f)
+    sgnr = signer(KEYID, gpg_home = GPGHOME)
+    todo = []
+    for f in fpaths:
+        st = os.stat(f)
+        if args.force or hashstate.get(f, [None, None])[:2] != [st.st_size, st.st_mtime]:
+            todo.append(f)
+    print('Hashing {0} of {1} files...'.format(len(todo), len(fpaths)))
+    start = time.time()
+    with ProcessPoolExecutor(max_workers = args.workers) as pool:
+        for done, job in enumerate(as_completed([pool.submit(hashFile, f) for f in todo]), start = 1):
+            fpath, sha = job.result()
+            st = os.stat(fpath)
+            hashstate[fpath] = [st.st_size, st.st_mtime, sha]
+            if done % 100 == 0 or done == len(todo):
+                elapsed = time.time() - start
+                print('\t{0}/{1} files hashed ({2:.1f} files/sec)'.format(done,
+                                                                         len(todo),
+                                                                         done / max(elapsed, 0.001)))
+    invalid = []
+    for seasondir, sfiles in sorted(seasons.items()):
+        sumsfile = os.path.join(seasondir, SUMSFILE)
+        valid = os.path.isfile(sumsfile) and sgnr.chkSigValid(sumsfile, sumsfile)
+        sums = (getSums(sumsfile) if os.path.isfile(sumsfile) else {})
+        for f in sfiles:
+            relpath = os.path.relpath(f, seasondir)
+            if sums.get(relpath) != hashstate[f][2]:
+                print('HASH {0}: {1}'.format(('MISMATCH' if relpath in sums else 'MISSING'), f))
+                sums[relpath] = hashstate[f][2]
+                valid = False
+        if valid:
+            continue
+        invalid.append(sumsfile)
+        if not args.dryrun:
+            putSums(sumsfile, sums)
+            sgnr.signEpFile(sumsfile, sumsfile)
+    saveState(os.path.abspath(os.path.expanduser(args.statefile)), state)
+    if args.dryrun:
+        print('{0} of {1} manifest(s) would be updated/re-signed:'.format(len(invalid), len(seasons)))
+        for f in invalid:
+            print('\t{0}'.format(f))
+    else:
+        print('{0} of {1} manifest(s) updated/re-signed.'.format(len(invalid), len(seasons)))
+
 def main(GPGHOME = GNUPGHOME, KEYID = GPGKEY,
          EPSPATH = EPPATH, FILEEXT = FILEEXTS):
+    args = parseArgs().parse_args()
+    statefile = os.path.abspath(os.path.expanduser(args.statefile))
+    state = loadState(statefile)
     fpaths = getEpFiles(EPSPATH, FILEEXT)
-    sig = signer(KEYID, gpg_home = GPGHOME)
-    print('Verifying files (and signing if necessary)...')
+    if args.manifest:
+        sumsMain(args, GPGHOME, KEYID, fpaths, state)
+        return()
+    todo = []
     for f in fpaths:
-        sigfilebase = os.path.abspath(
-                        os.path.join(
-                            os.path.dirname(f),
-                            os.path.join('..',
-                                         'gpg',
-                                         os.path.basename(f))))
-        if not sig.chkSigValid(f, sigfilebase):
-            sig.signEpFile(f, sigfilebase)
+        sigpath = '.'.join((getSigBase(f), re.sub(r'^\.', '', SIGEXT)))
+        if not args.force and state.get(f) == getFileState(f, sigpath) + [True]:
+            continue
+        todo.append(f)
+    print('Verifying {0} of {1} files (and {2})...'.format(len(todo),
+                                                         len(fpaths),
+                                                         ('reporting those that would be re-signed' if args.dryrun
+                                                                else 'signing if necessary')))
+    invalid = []
+    start = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers = args.workers,
+                                 initializer = initWorker,
+                                 initargs = (GPGHOME, KEYID)) as pool:
+            jobs = [pool.submit(procFile, f, dryrun = args.dryrun) for f in todo]
+            for done, job in enumerate(as_completed(jobs), start = 1):
+                fpath, valid, fstate = job.result()
+                if not valid:
+                    invalid.append(fpath)
+                if valid or not args.dryrun:
+                    state[fpath] = fstate + [True]
+                else:
+                    state.pop(fpath, None)
+                if done % 100 == 0 or done == len(todo):
+                    elapsed = time.time() - start
+                    print('\t{0}/{1} files checked ({2:.1f} files/sec)'.format(done,
+                                                                              len(todo),
+                                                                              done / max(elapsed, 0.001)))
+    finally:
+        saveState(statefile, state)
+    if args.dryrun:
+        print('{0} file(s) would be re-signed:'.format(len(invalid)))
+        for f in sorted(invalid):
+            print('\t{0}'.format(f))
+    else:
+        print('{0} file(s) re-signed.'.format(len(invalid)))
 
 if __name__ == '__main__':
     main()
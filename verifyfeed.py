@@ -5,13 +5,13 @@
 import hashlib
 import argparse
 import os
-import glob
-from urllib.request import urlopen
-try:
-    from lxml import etree
-except ImportError:
-    import xml.etree.ElementTree as etree
-# TODO: GPG verification too
+import json
+import threading
+import http.client
+from urllib.parse import urlsplit, urljoin
+from concurrent.futures import ThreadPoolExecutor
+# lxml (or the stdlib's ElementTree if it isn't installed) is only loaded once there's a feed to parse; see xmlLib().
+etree = None
 
 baseurl = 'https://sysadministrivia.com'
 
@@ -20,51 +20,253 @@ feeds = {'itunes':'/feed/itunes.xml',
          'mp3':'/feed/podcast.xml',
          'ogg':'/feed/oggcast.xml'}
 
+def xmlLib():
+    global etree
+    if etree is None:
+        try:
+            from lxml import etree as lib
+        except ImportError:
+            import xml.etree.ElementTree as lib
+        etree = lib
+    return(etree)
+
+# How much to read at a time when downloading.
+fetch_bufsize = 1048576
+
+# Each thread keeps one open (keep-alive) connection per server. See getConn().
+conn_local = threading.local()
+
+def getConn(scheme, netloc, reset = False):
+    conns = conn_local.__dict__.setdefault('conns', {})
+    if reset and (scheme, netloc) in conns:
+        conns.pop((scheme, netloc)).close()
+    if (scheme, netloc) not in conns:
+        if scheme == 'https':
+            conns[(scheme, netloc)] = http.client.HTTPSConnection(netloc, timeout = 60)
+        else:
+            conns[(scheme, netloc)] = http.client.HTTPConnection(netloc, timeout = 60)
+    return(conns[(scheme, netloc)])
+
+def openURL(uri, redirects = 5):
+    # Like urlopen(), but reuses this thread's connection to the server. The response must be read fully.
+    for i in range(redirects + 1):
+        u = urlsplit(uri)
+        path = u.path or '/'
+        if u.query:
+            path += '?' + u.query
+        for attempt in (1, 2):
+            # A kept-alive connection may have been closed by the server in the meantime.
+            conn = getConn(u.scheme, u.netloc, reset = (attempt == 2))
+            try:
+                conn.request('GET', path, headers = {'User-Agent': 'Podloader-verifyfeed'})
+                resp = conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if attempt == 2:
+                    raise
+        if resp.status in (301, 302, 303, 307, 308):
+            resp.read()
+            uri = urljoin(uri, resp.getheader('Location'))
+            continue
+        if resp.status != 200:
+            resp.read()
+            raise http.client.HTTPException('{0} returned HTTP {1}'.format(uri, resp.status))
+        return(resp)
+    raise http.client.HTTPException('Too many redirects for {0}'.format(uri))
+
 def getXML(baseurl, feeds, args):
     xml = {}
     print('Fetching feed(s) XML, please wait...')
-    for feed in args.feedlist:
-        with urlopen(baseurl + feeds[feed]) as url:
-            xml[feed] = etree.fromstring(url.read())
+    def fetch(feed):
+        return(xmlLib().fromstring(openURL(baseurl + feeds[feed]).read()))
+    with ThreadPoolExecutor(max_workers = args.jobs) as pool:
+        jobs = {feed: pool.submit(fetch, feed) for feed in args.feedlist}
+        for feed, job in jobs.items():
+            xml[feed] = job.result()
     return(xml)
 
-def getSums(xml, args):
+def getLiveSum(uri):
+    livesha = hashlib.sha256()
+    resp = openURL(uri)
+    for chunk in iter(lambda: resp.read(fetch_bufsize), b''):
+        livesha.update(chunk)
+    return(livesha.hexdigest())
+
+# The per-season checksum manifest podloader keeps next to the episodes, and its detached signature.
+sumsfile = 'SHA256SUMS'
+sigfile = 'SHA256SUMS.asc'
+
+def verifySig(data, sig):
+    # Needs the publisher's key in your (GNUPGHOME's) keyring. gpg (the GPGME bindings) is only needed for -g.
+    import gpg
+    import gpg.errors
+    try:
+        with gpg.Context() as ctx:
+            ctx.verify(data, signature = sig)
+        return(True)
+    except (gpg.errors.BadSignatures, gpg.errors.GPGMEError):
+        return(False)
+
+def getSeasonSums(root):
+    # Returns ({path relative to the season: sha256}, signature) for the season at root, where signature is
+    # 'good', 'bad' or 'unsigned' (e.g. published with GPG off), or (None, None) if there's no manifest.
+    try:
+        data = openURL('{0}/{1}'.format(root, sumsfile)).read()
+    except http.client.HTTPException as e:
+        print('\tWARNING: {0}'.format(e))
+        return(None, None)
     sums = {}
+    for line in data.decode('utf-8').splitlines():
+        if len(line) > 66 and line[65] in ' *':
+            sums[line[66:]] = line[:64]
+    try:
+        sig = openURL('{0}/{1}'.format(root, sigfile)).read()
+    except http.client.HTTPException:
+        return(sums, 'unsigned')
+    return(sums, ('good' if verifySig(data, sig) else 'bad'))
+
+def checkSums(sums, args):
+    # One signature check per season instead of per file: the GUIDs (the SHA256 of each file; see --live and
+    # --directory for checking those against the files themselves) are compared to the signed manifest.
+    # The enclosure URLs are .../S<season>/E<episode>/<format>/<file>, and the manifest is in .../S<season>/.
+    seasons = {}
     for feed in args.feedlist:
-        sums[feed] = {}
-        for episode in xml[feed].findall('channel/item'):
-            epID = episode.find('title').text.split(':')[0]
-            sums[feed][epID] = {}
-            sums[feed][epID]['uri'] = episode.find('enclosure').attrib['url']
-            sums[feed][epID]['guid'] = episode.find('guid').text
-            sums[feed][epID]['file'] = os.path.basename(sums[feed][epID]['uri'])
-            if args.livesums:
-                livesha = hashlib.sha256()
-                print('{0}({1}): Fetching/verifying live sum...'.format(epID, feed))
-                with urlopen(sums[feed][epID]['uri']) as url:
-                    for chunk in iter(lambda: url.read(4096), b''):
-                        livesha.update(chunk)
-                sums[feed][epID]['livesha'] = livesha.hexdigest()
+        for epID, ep in sums[feed].items():
+            root, relpath = ep['uri'].rsplit('/', 3)[0], '/'.join(ep['uri'].rsplit('/', 3)[1:])
+            seasons.setdefault(root, []).append((feed, epID, relpath, ep['guid']))
+    print('Checking the GUIDs against {0} signed manifest(s)...'.format(len(seasons)))
+    with ThreadPoolExecutor(max_workers = args.jobs) as pool:
+        results = dict(zip(seasons, pool.map(getSeasonSums, seasons)))
+    bad = 0
+    for root, items in sorted(seasons.items()):
+        seasonsums, signature = results[root]
+        if seasonsums is None:
+            print('\tWARNING: {0}/{1} is missing; not checking its {2} GUID(s)!'.format(root, sumsfile, len(items)))
+            continue
+        if signature == 'bad':
+            print('\tWARNING: {0}/{1} has a bad signature!'.format(root, sumsfile))
+        elif signature == 'unsigned':
+            print('\tWARNING: {0}/{1} is not signed ({2} is missing)!'.format(root, sumsfile, sigfile))
+        for feed, epID, relpath, guid in items:
+            if seasonsums.get(relpath) != guid:
+                bad += 1
+                print('\tWARNING: {0}({1}): GUID {2} does not match the manifest\'s {3}!'.format(epID,
+                                                                                               feed,
+                                                                                               guid,
+                                                                                               seasonsums.get(relpath)))
+    print('Finished checking the manifests ({0} mismatch(es)).'.format(bad))
+
+def getIndex(localdir):
+    # One walk of the tree instead of a recursive glob per episode; returns {filename: [paths]}.
+    index = {}
+    for root, dirs, files in os.walk(localdir):
+        for f in files:
+            index.setdefault(f, []).append(os.path.join(root, f))
+    return(index)
+
+def loadCache(cachefile):
+    try:
+        with open(cachefile, 'r') as f:
+            return(json.load(f))
+    except (FileNotFoundError, ValueError):
+        return({})
+
+def saveCache(cachefile, cache):
+    os.makedirs(os.path.dirname(cachefile), exist_ok = True)
+    tmpfile = '{0}.{1}'.format(cachefile, os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmpfile, cachefile)
+
+def getLocalSum(localfile, cache):
+    # Returns (sha256, [size, mtime, sha256]); files whose size and mtime match the cache aren't read again.
+    st = os.stat(localfile)
+    cached = cache.get(localfile)
+    if cached and cached[:2] == [st.st_size, st.st_mtime]:
+        return(cached[2], cached)
+    localsha = hashlib.sha256()
+    with open(localfile, 'rb') as f:
+        for chunk in iter(lambda: f.read(fetch_bufsize), b''):
+            localsha.update(chunk)
+    return(localsha.hexdigest(), [st.st_size, st.st_mtime, localsha.hexdigest()])
+
+def itemInfo(episode):
+    # Returns (episode ID, enclosure URL, GUID) for a channel/item element.
+    return(episode.find('title').text.split(':')[0],
+           episode.find('enclosure').attrib['url'],
+           episode.find('guid').text)
+
+def getItems(tree):
+    for episode in tree.findall('channel/item'):
+        yield(itemInfo(episode))
+
+def streamItems(uri):
+    # Like getItems(), but parses the feed as it downloads and throws each item away once it's been read,
+    # so memory use stays flat no matter how big the feed (and its show notes) is.
+    resp = openURL(uri)
+    for event, elem in xmlLib().iterparse(resp, events = ('end',)):
+        if elem.tag == 'item':
+            yield(itemInfo(elem))
+            elem.clear()
+            # lxml also keeps the (now empty) elements around in the parent; drop them too.
+            if hasattr(elem, 'getprevious'):
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+    resp.read()
+
+def getSums(items, args):
+    # items is {feed: iterable of (episode ID, enclosure URL, GUID)}; the feeds are read concurrently,
+    # and with --live each file starts downloading as soon as its item has been read.
+    sums = {}
+    livejobs = {}
+    lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers = args.jobs) as pool:
+        def collect(feed):
+            sums[feed] = {}
+            for epID, uri, guid in items[feed]:
+                sums[feed][epID] = {}
+                sums[feed][epID]['uri'] = uri
+                sums[feed][epID]['guid'] = guid
+                sums[feed][epID]['file'] = os.path.basename(uri)
+                if args.livesums:
+                    # The mp3/itunes/google feeds all point at the same files, so each unique URL is only fetched once.
+                    with lock:
+                        if uri not in livejobs:
+                            livejobs[uri] = pool.submit(getLiveSum, uri)
+        if args.livesums:
+            print('Fetching/verifying live sums...')
+        with ThreadPoolExecutor(max_workers = len(args.feedlist)) as feedpool:
+            for job in [feedpool.submit(collect, feed) for feed in args.feedlist]:
+                job.result()
+        for feed in (args.feedlist if args.livesums else []):
+            for epID in sums[feed]:
+                sums[feed][epID]['livesha'] = livejobs[sums[feed][epID]['uri']].result()
                 if sums[feed][epID]['livesha'] != sums[feed][epID]['guid']:
-                    print('\t\tWARNING: GUID {1} does not match live sum {1}!'.format(sums[feed][epID]['guid'],
-                                                                                      sums[feed][epID]['livesha']))
+                    print('\t\tWARNING: {0}({1}): GUID {2} does not match live sum {3}!'.format(epID,
+                                                                                              feed,
+                                                                                              sums[feed][epID]['guid'],
+                                                                                              sums[feed][epID]['livesha']))
     if args.locdir:
         localdir = os.path.abspath(os.path.expanduser(args.locdir))
         if not os.path.isdir(localdir):
             exit('ERROR: Directory {0} does not exist!'.format(args.locdir))
         episodes = sums[args.feedlist[0]]
         print('Checking local files...')
+        index = getIndex(localdir)
+        cachefile = os.path.abspath(os.path.expanduser(args.cachefile))
+        cache = loadCache(cachefile)
+        checks = []
         for episode in episodes.keys():
-            filename = episodes[episode]['file']
-            guid = episodes[episode]['guid']
-            for localfile in glob.iglob('{0}/**/{1}'.format(localdir, filename), recursive = True):
-                localsha = hashlib.sha256()
+            for localfile in index.get(episodes[episode]['file'], []):
+                checks.append((localfile, episodes[episode]['guid']))
+        with ThreadPoolExecutor(max_workers = args.jobs) as pool:
+            results = pool.map(lambda c: getLocalSum(c[0], cache), checks)
+            for (localfile, guid), (localsha, fstate) in zip(checks, results):
                 print('Checking {0}...'.format(localfile))
-                with open(localfile, 'rb') as f:
-                    for chunk in iter(lambda: f.read(4096), b''):
-                        localsha.update(chunk)
-                if localsha.hexdigest() != guid:
-                    print('WARNING: GUID {0} does not match local hash {1}!'.format(guid, localsha.hexdigest()))
+                cache[localfile] = fstate
+                if localsha != guid:
+                    print('WARNING: GUID {0} does not match local hash {1}!'.format(guid, localsha))
+        saveCache(cachefile, cache)
         print('Finished checking local files.')
     if not args.locdir and not args.livesums:
         for episode in sums[args.feedlist[0]].keys():
@@ -95,12 +297,40 @@ def parseArgs():
                       metavar = 'path',
                       default = False,
                       help = 'If specified, a directory where local copies of the episodes exist. (e.g. ~/gPodder/Downloads/Sysadministrivia)')
+    args.add_argument('-j',
+                      '--jobs',
+                      dest = 'jobs',
+                      type = int,
+                      default = 4,
+                      help = 'How many feeds/files to download (or local files to hash) at once. The default is 4.')
+    args.add_argument('-g',
+                      '--gpg',
+                      dest = 'sums',
+                      action = 'store_true',
+                      help = 'If specified, verify the signature on each season\'s {0} once and check every GUID against it. Needs the gpg (GPGME) Python bindings and the publisher\'s key.'.format(sumsfile))
+    args.add_argument('-s',
+                      '--stream',
+                      dest = 'stream',
+                      action = 'store_true',
+                      help = 'If specified, parse the feeds while they download instead of loading them fully first. Uses much less memory for big feeds, and --live checks start sooner.')
+    args.add_argument('-c',
+                      '--cache',
+                      dest = 'cachefile',
+                      metavar = 'path',
+                      default = '~/.cache/podloader/verifyfeed.json',
+                      help = 'Where to cache the hashes of local files (by path, size and mtime) between runs. The default is ~/.cache/podloader/verifyfeed.json.')
     return(args)
 
 def main():
     args = parseArgs().parse_args()
-    xml = getXML(baseurl, feeds, args)
-    sums = getSums(xml, args)
+    if args.stream:
+        items = {feed: streamItems(baseurl + feeds[feed]) for feed in args.feedlist}
+    else:
+        xml = getXML(baseurl, feeds, args)
+        items = {feed: getItems(xml[feed]) for feed in args.feedlist}
+    sums = getSums(items, args)
+    if args.sums:
+        checkSums(sums, args)
 
 if __name__ == '__main__':
     main()